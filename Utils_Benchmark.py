@@ -0,0 +1,191 @@
+############################################################################################
+#                       Benchmarks of the covering engine
+############################################################################################
+# numpy and math
+import numpy as np
+from math import pi
+# Time, memory and processes
+import time
+import resource
+import multiprocessing
+# Saving the results
+import os
+import json
+import shutil
+import tempfile
+import argparse
+# The covering
+from Utils_NUC import Box, CoveringTree
+from Utils_Plotting import PlottingTree
+
+############################################################################################
+# Vectorized interval arithmetic over the arrays of the lower and upper bounds
+############################################################################################
+def isq(lo, hi):
+    a = lo*lo
+    b = hi*hi
+    return np.where(np.logical_and(lo <= 0, hi >= 0), 0.0, np.minimum(a, b)), np.maximum(a, b)
+
+def icos(lo, hi):
+    vals = np.stack((np.cos(lo), np.cos(hi)))
+    minval = np.min(vals, axis=0)
+    maxval = np.max(vals, axis=0)
+    # The extrema inside the intervals
+    withMax = np.ceil(lo/(2*pi))*2*pi <= hi
+    withMin = np.ceil((lo - pi)/(2*pi))*2*pi + pi <= hi
+    return np.where(withMin, -1.0, minval), np.where(withMax, 1.0, maxval)
+
+def isin(lo, hi):
+    return icos(lo - pi/2, hi - pi/2)
+
+def iscale(c, lo, hi):
+    return np.minimum(c*lo, c*hi), np.maximum(c*lo, c*hi)
+
+############################################################################################
+# Reference problems
+############################################################################################
+class BenchmarkCovering(CoveringTree, PlottingTree):
+    # The reference problems have the vectorized enclosures only
+    def __init__(self, iBox, idelta, ieps=0.0):
+        CoveringTree.__init__(self, iBox, idelta, False, ieps)
+        PlottingTree.__init__(self, iBox, False)
+
+    def AdditionalPlotting(self, ax):
+        pass
+
+class BallCovering(BenchmarkCovering):
+    # The ball of the radius 1 in any dimension: sum(x_i^2) - 1 <= 0
+    def getMinMaxVals(self, bounds, diams):
+        lo, hi = isq(bounds[:, :, 0], bounds[:, :, 1])
+        return np.sum(lo, axis=1) - 1.0, np.sum(hi, axis=1) - 1.0
+
+class AnnulusCovering(BenchmarkCovering):
+    # 0.25 <= x^2 + y^2 <= 1
+    def getMinMaxVals(self, bounds, diams):
+        xl, xh = isq(bounds[:, 0, 0], bounds[:, 0, 1])
+        yl, yh = isq(bounds[:, 1, 0], bounds[:, 1, 1])
+        return np.maximum(xl + yl - 1.0, 0.25 - xh - yh), np.maximum(xh + yh - 1.0, 0.25 - xl - yl)
+
+class CableRobotCovering(BenchmarkCovering):
+    # A planar cable robot (x, y, angle) with four cables: the length of every cable
+    # must be within [lmin, lmax], so there are eight constraints
+    anchors = np.array([[-2.0, -2.0], [2.0, -2.0], [2.0, 2.0], [-2.0, 2.0]])
+    points = np.array([[-0.2, -0.1], [0.2, -0.1], [0.2, 0.1], [-0.2, 0.1]])
+    lmin = 0.5
+    lmax = 3.5
+
+    def getMinMaxVals(self, bounds, diams):
+        cl, ch = icos(bounds[:, 2, 0], bounds[:, 2, 1])
+        sl, sh = isin(bounds[:, 2, 0], bounds[:, 2, 1])
+        minvals = np.full(bounds.shape[0], -np.inf)
+        maxvals = np.full(bounds.shape[0], -np.inf)
+        for anchor, point in zip(self.anchors, self.points):
+            # anchor - (x, y) - R(angle)*point
+            rxl, rxh = np.add(iscale(point[0], cl, ch), iscale(-point[1], sl, sh))
+            ryl, ryh = np.add(iscale(point[0], sl, sh), iscale(point[1], cl, ch))
+            dxl, dxh = isq(anchor[0] - bounds[:, 0, 1] - rxh, anchor[0] - bounds[:, 0, 0] - rxl)
+            dyl, dyh = isq(anchor[1] - bounds[:, 1, 1] - ryh, anchor[1] - bounds[:, 1, 0] - ryl)
+            # lmin^2 - l^2 <= 0 and l^2 - lmax^2 <= 0
+            minvals = np.maximum(minvals, np.maximum(self.lmin**2 - dxh - dyh, dxl + dyl - self.lmax**2))
+            maxvals = np.maximum(maxvals, np.maximum(self.lmin**2 - dxl - dyl, dxh + dyh - self.lmax**2))
+        return minvals, maxvals
+
+def getProblem(name, dim=2):
+    if name == 'disk':
+        return BallCovering, Box([-2.0]*2, [4.0]*2)
+    if name == 'ball':
+        return BallCovering, Box([-2.0]*dim, [4.0]*dim)
+    if name == 'annulus':
+        return AnnulusCovering, Box([-2.0]*2, [4.0]*2)
+    if name == 'cablerobot':
+        return CableRobotCovering, Box([-2.0, -2.0, -pi/4], [4.0, 4.0, pi/2])
+    raise ValueError('Unknown problem: {}'.format(name))
+
+############################################################################################
+# Measurements
+############################################################################################
+def _getMaxRSS():
+    # The peak resident set size of the process in bytes (ru_maxrss is in kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def runCase(case):
+    # Solve a problem and time the parts of the work separately,
+    # every case runs in its own process so the peak memory is its own
+    cls, iBox = getProblem(case['problem'], case.get('dim', 2))
+    oCov = cls(iBox, case['idelta'])
+    oCov.setQuiet()
+    nRSS = _getMaxRSS()
+    tStart = time.time()
+    oCov.getSolution(case['maxLevels'])
+    tSolve = time.time() - tStart
+    stats = oCov.getStatistics()
+    leaves = oCov.getLeaves()
+    nBoxes = oCov.getNodes()['level'].shape[0]
+    res = dict(case)
+    res.update({'boxes': int(nBoxes), 'leaves': int(leaves['level'].shape[0]),
+                'levels': oCov.getResProcessedLevels(), 'iterations': oCov.getResIterations(),
+                'solveTime': tSolve, 'boxesPerSecond': nBoxes/tSolve if tSolve > 0 else None,
+                'levelTimes': [level['time'] for level in stats],
+                'evalTime': sum(level['evalTime'] for level in stats),
+                'engineTime': sum(level['engineTime'] for level in stats),
+                'peakMemoryPerBox': float(max(_getMaxRSS() - nRSS, 0))/nBoxes})
+    if case.get('io', False):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fName = os.path.join(tmpDir, 'covering')
+            for asArrays, key in ((False, 'pickle'), (True, 'arrays')):
+                tStart = time.time()
+                oCov.SaveSolution(fName + key, asArrays=asArrays)
+                res[key + 'SaveTime'] = time.time() - tStart
+                tStart = time.time()
+                oCov.LoadSolution(fName + key)
+                oCov.getNodes()
+                res[key + 'LoadTime'] = time.time() - tStart
+            for raster, key in ((True, 'raster'), (False, 'vector')):
+                tStart = time.time()
+                oCov.saveResultAsImage(leaves, fName + key + '.png', raster=raster)
+                res[key + 'ImageTime'] = time.time() - tStart
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+    return res
+
+def getCases(quick=False):
+    deltas = [0.05, 0.02] if quick else [0.05, 0.02, 0.01, 0.005, 0.002]
+    cases = []
+    for problem in ('disk', 'annulus'):
+        for idelta in deltas:
+            cases.append({'problem': problem, 'idelta': idelta, 'maxLevels': 64})
+    for dim in ((2, 3) if quick else (2, 3, 4)):
+        cases.append({'problem': 'ball', 'dim': dim, 'idelta': 0.1, 'maxLevels': 64})
+    for maxLevels in ((8, 12) if quick else (8, 12, 16, 20)):
+        cases.append({'problem': 'cablerobot', 'idelta': 0.0, 'maxLevels': maxLevels})
+    cases.append({'problem': 'cablerobot', 'idelta': 0.1 if quick else 0.05, 'maxLevels': 64, 'io': True})
+    return cases
+
+def runBenchmarks(fName, quick=False):
+    results = []
+    for case in getCases(quick):
+        oPool = multiprocessing.Pool(1)
+        try:
+            res = oPool.apply(runCase, (case,))
+        finally:
+            oPool.close()
+            oPool.join()
+        # The dimension tells the cases of a problem with several dimensions apart
+        sDim = 'dim={}, '.format(res['dim']) if 'dim' in res else ''
+        print '{problem} ({sDim}delta={idelta}, maxLevels={maxLevels}): {boxes} boxes in {solveTime:.3f} s, ' \
+              '{boxesPerSecond:.0f} boxes/s'.format(sDim=sDim, **res)
+        results.append(res)
+    with open(fName, 'w') as outfile:
+        json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, outfile, indent=1)
+    return results
+
+if __name__ == '__main__':
+    # The images of the benchmarks are drawn without a display whatever the environment is
+    import matplotlib
+    matplotlib.use('Agg')
+    parser = argparse.ArgumentParser(description='Benchmarks of the covering engine')
+    parser.add_argument('fName', nargs='?', default='benchmark.json', help='the file to save the results to')
+    parser.add_argument('--quick', action='store_true', help='the small cases only')
+    args = parser.parse_args()
+    runBenchmarks(args.fName, args.quick)
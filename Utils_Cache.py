@@ -0,0 +1,158 @@
+############################################################################################
+#                       Caching the enclosures of the boxes
+############################################################################################
+# numpy
+import numpy as np
+# LRU
+from collections import OrderedDict
+# On-disk store
+import sqlite3
+
+class MinMaxCache(object):
+############################################################################################
+# Constructor
+############################################################################################
+    def __init__(self, signature, maxSize=1000000):
+        # The signature tells the problems apart, e.g. the name of the model and its parameters.
+        # The boxes are the keys as they are: the bisection from the same initial box
+        # gives exactly the same bounds in every run
+        self._signature = '{}'.format(signature)
+        self._maxSize = maxSize
+        self.__items = OrderedDict()
+        self._nHits = 0
+        self._nMisses = 0
+        self._nEvictions = 0
+
+############################################################################################
+# Public Members
+############################################################################################
+    def getStatistics(self):
+        nLookups = self._nHits + self._nMisses
+        return {'hits': self._nHits, 'misses': self._nMisses, 'evictions': self._nEvictions,
+                'size': self.getSize(), 'hitRate': float(self._nHits)/nLookups if nLookups else 0.0}
+
+    def getSize(self):
+        return len(self.__items)
+
+    def lookup(self, bounds):
+        # Get the mask of the found boxes and their min/max values, bounds are of the shape (N, dim, 2)
+        keys = self._getKeys(bounds)
+        found = np.zeros(len(keys), dtype=bool)
+        minvals = np.full(len(keys), np.nan)
+        maxvals = np.full(len(keys), np.nan)
+        for idx, key in enumerate(keys):
+            item = self.__items.pop(key, None)
+            if item is not None:
+                # The most recently used items are at the end
+                self.__items[key] = item
+                found[idx] = True
+                minvals[idx], maxvals[idx] = item
+        self._count(found)
+        return found, minvals, maxvals
+
+    def store(self, bounds, minvals, maxvals):
+        for key, minval, maxval in zip(self._getKeys(bounds), minvals, maxvals):
+            self.__items.pop(key, None)
+            self.__items[key] = (float(minval), float(maxval))
+        # Get rid of the least recently used items
+        while self._maxSize is not None and len(self.__items) > self._maxSize:
+            self.__items.popitem(last=False)
+            self._nEvictions = self._nEvictions + 1
+
+    def clear(self):
+        self.__items.clear()
+
+############################################################################################
+# Private Members
+############################################################################################
+    def _getKeys(self, bounds):
+        bounds = np.ascontiguousarray(bounds, dtype=float)
+        return [self._signature + ':' + box.tobytes() for box in bounds]
+
+    def _count(self, found):
+        nFound = int(np.sum(found))
+        self._nHits = self._nHits + nFound
+        self._nMisses = self._nMisses + found.shape[0] - nFound
+
+class DiskMinMaxCache(MinMaxCache):
+############################################################################################
+# Constructor
+############################################################################################
+    def __init__(self, fName, signature, maxSize=None):
+        # The values are kept in an SQLite database, so they are shared between the runs;
+        # the least recently used ones are removed if maxSize is given
+        MinMaxCache.__init__(self, signature, maxSize)
+        self.__fName = fName
+        self.__conn = sqlite3.connect(fName)
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, '
+                            'minval REAL, maxval REAL, used INTEGER)')
+        self.__conn.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+        self.__nUsed = self.__conn.execute('SELECT COALESCE(MAX(used), 0) FROM cache').fetchone()[0]
+        # The database could be made with another size bound
+        self.__evict()
+
+    # The connection could not be passed to a worker process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_DiskMinMaxCache__conn']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__conn = sqlite3.connect(self.__fName)
+
+############################################################################################
+# Public Members
+############################################################################################
+    def getSize(self):
+        return self.__conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def lookup(self, bounds):
+        keys = [sqlite3.Binary(key) for key in self._getKeys(bounds)]
+        found = np.zeros(len(keys), dtype=bool)
+        minvals = np.full(len(keys), np.nan)
+        maxvals = np.full(len(keys), np.nan)
+        positions = dict((str(key), idx) for idx, key in enumerate(keys))
+        # SQLite limits the number of the parameters of a query
+        for first in range(0, len(keys), 500):
+            chunk = keys[first:first + 500]
+            rows = self.__conn.execute('SELECT key, minval, maxval FROM cache WHERE key IN ({})'.format( \
+                                       ','.join('?'*len(chunk))), chunk).fetchall()
+            for key, minval, maxval in rows:
+                idx = positions[str(key)]
+                found[idx] = True
+                minvals[idx] = minval
+                maxvals[idx] = maxval
+        if self._maxSize is not None and found.any():
+            self.__nUsed = self.__nUsed + 1
+            self.__conn.executemany('UPDATE cache SET used = ? WHERE key = ?', \
+                                    [(self.__nUsed, keys[idx]) for idx in np.nonzero(found)[0]])
+        self._count(found)
+        return found, minvals, maxvals
+
+    def store(self, bounds, minvals, maxvals):
+        self.__nUsed = self.__nUsed + 1
+        self.__conn.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', \
+                                [(sqlite3.Binary(key), float(minval), float(maxval), self.__nUsed) \
+                                 for key, minval, maxval in zip(self._getKeys(bounds), minvals, maxvals)])
+        self.__evict()
+
+    def clear(self):
+        self.__conn.execute('DELETE FROM cache')
+        self.__conn.commit()
+
+    def close(self):
+        self.__conn.close()
+
+############################################################################################
+# Private Members
+############################################################################################
+    def __evict(self):
+        # Get rid of the least recently used items
+        if self._maxSize is not None:
+            nExtra = self.getSize() - self._maxSize
+            if nExtra > 0:
+                self.__conn.execute('DELETE FROM cache WHERE key IN '
+                                    '(SELECT key FROM cache ORDER BY used LIMIT ?)', (nExtra,))
+                self._nEvictions = self._nEvictions + nExtra
+        self.__conn.commit()
@@ -0,0 +1,134 @@
+############################################################################################
+#                          Queries over a finished covering
+############################################################################################
+# numpy
+import numpy as np
+# Loading the arrays of a covering
+from Utils_NUC import loadNodes, getChildren
+
+# The classes of the points and boxes
+INNER = 1
+BOUNDARY = 0
+OUTER = -1
+
+class CoveringIndex(object):
+############################################################################################
+# Constructor
+############################################################################################
+    def __init__(self, nodes):
+        # nodes are the arrays of CoveringTree.getNodes(): the children of a box are
+        # stored next to each other, so the index descends the bisection tree
+        # like a k-d tree without any ete3 objects
+        self.__lower = np.asarray(nodes['corner'])
+        self.__upper = self.__lower + np.asarray(nodes['sides'])
+        nNodes = self.__lower.shape[0]
+        self.__firstChild, self.__nChildren = getChildren(np.asarray(nodes['parent']))
+        self.__maxChildren = int(self.__nChildren.max())
+        # The classes of the leaves, the undecided ones are in the boundary
+        self.__classes = np.full(nNodes, OUTER, dtype=np.int8)
+        self.__classes[np.logical_or(nodes['inQE'], nodes['cont'])] = BOUNDARY
+        self.__classes[np.asarray(nodes['inQI'])] = INNER
+        self.__classes[np.asarray(nodes['split'])] = BOUNDARY
+
+    @classmethod
+    def fromCovering(cls, oCovering):
+        return cls(oCovering.getNodes())
+
+    @classmethod
+    def fromFile(cls, fName, mmap=True):
+        # The covering saved by SaveSolution(fName, asArrays=True)
+        nodes, header = loadNodes(fName, mmap)
+        return cls(nodes)
+
+############################################################################################
+# Public Members
+############################################################################################
+    def getNumberOfLeaves(self):
+        return int(np.sum(self.__firstChild < 0))
+
+    def getLeafBounds(self, leaves):
+        return np.stack((self.__lower[leaves], self.__upper[leaves]), axis=2)
+
+    def findLeaves(self, points):
+        # Get the index of the leaf containing every point, -1 for the points out of the initial box
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        leaves = np.where(self.__contains(np.zeros(points.shape[0], dtype=np.int64), points), 0, -1)
+        active = np.nonzero(np.logical_and(leaves >= 0, self.__firstChild[np.maximum(leaves, 0)] >= 0))[0]
+        # Descend all of the points level by level
+        while active.shape[0]:
+            nodes = leaves[active]
+            pts = points[active]
+            found = np.full(active.shape[0], -1, dtype=np.int64)
+            for idx in range(self.__maxChildren):
+                child = self.__firstChild[nodes] + idx
+                check = np.logical_and(idx < self.__nChildren[nodes], found < 0)
+                inside = np.logical_and(check, self.__contains(np.where(check, child, 0), pts))
+                found[inside] = child[inside]
+            leaves[active] = found
+            active = active[found >= 0]
+            active = active[self.__firstChild[leaves[active]] >= 0]
+        return leaves
+
+    def classifyPoints(self, points):
+        # INNER for the points in the inner approximation (inQI), BOUNDARY for inQE and
+        # OUTER for the rest of the points
+        leaves = self.findLeaves(points)
+        return np.where(leaves >= 0, self.__classes[np.maximum(leaves, 0)], OUTER)
+
+    def findOverlapping(self, lowers, uppers):
+        # Get the pairs (query, leaf) for the leaves overlapping the query boxes,
+        # the boxes only touching each other do not overlap
+        lowers = np.atleast_2d(np.asarray(lowers, dtype=float))
+        uppers = np.atleast_2d(np.asarray(uppers, dtype=float))
+        queries = np.arange(lowers.shape[0])
+        nodes = np.zeros(lowers.shape[0], dtype=np.int64)
+        resQueries = []
+        resLeaves = []
+        while queries.shape[0]:
+            overlap = self.__overlaps(nodes, lowers[queries], uppers[queries])
+            queries = queries[overlap]
+            nodes = nodes[overlap]
+            leaf = self.__firstChild[nodes] < 0
+            resQueries.append(queries[leaf])
+            resLeaves.append(nodes[leaf])
+            # Go down to the children of the rest of the boxes
+            queries = queries[np.logical_not(leaf)]
+            nodes = nodes[np.logical_not(leaf)]
+            nChildren = self.__nChildren[nodes]
+            offsets = np.arange(np.sum(nChildren)) - np.repeat(np.cumsum(nChildren) - nChildren, nChildren)
+            queries = np.repeat(queries, nChildren)
+            nodes = np.repeat(self.__firstChild[nodes], nChildren) + offsets
+        return np.concatenate(resQueries), np.concatenate(resLeaves)
+
+    def classifyBoxes(self, lowers, uppers):
+        # INNER if the whole box is in the inner approximation, OUTER if it is out of it
+        # and BOUNDARY otherwise
+        lowers = np.atleast_2d(np.asarray(lowers, dtype=float))
+        uppers = np.atleast_2d(np.asarray(uppers, dtype=float))
+        queries, leaves = self.findOverlapping(lowers, uppers)
+        classes = self.__classes[leaves]
+        minClass = np.full(lowers.shape[0], OUTER, dtype=np.int8)
+        maxClass = np.full(lowers.shape[0], OUTER, dtype=np.int8)
+        if queries.shape[0]:
+            minClass[np.unique(queries)] = INNER
+            np.minimum.at(minClass, queries, classes)
+            np.maximum.at(maxClass, queries, classes)
+        # The part of a box out of the initial box is out of the covering
+        outside = np.logical_not(np.all(np.logical_and(lowers >= self.__lower[0], uppers <= self.__upper[0]), axis=1))
+        minClass[outside] = OUTER
+        return np.where(minClass == maxClass, minClass, BOUNDARY)
+
+############################################################################################
+# Private Members
+############################################################################################
+    def __contains(self, nodes, points):
+        return np.all(np.logical_and(points >= self.__lower[nodes], points <= self.__upper[nodes]), axis=1)
+
+    def __overlaps(self, nodes, lowers, uppers):
+        lower = self.__lower[nodes]
+        upper = self.__upper[nodes]
+        # A flat query box overlaps the boxes it touches in the flat dimensions
+        flat = lowers == uppers
+        overlap = np.where(flat, np.logical_and(lowers >= lower, uppers <= upper),
+                           np.logical_and(lowers < upper, uppers > lower))
+        return np.all(overlap, axis=1)
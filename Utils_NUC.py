@@ -6,16 +6,20 @@ import abc
 # numpy and math
 import numpy as np
 from math import sqrt
-# Tree
-from ete3 import Tree
 # Saving
 import cPickle
 import os
+import json
+import shutil
+# Parallel covering
+import multiprocessing
+# Statistics
+import time
+# Streaming covering
+import heapq
 from interval import interval
-# Plotting
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from Utils_Plotting import PlottingTree
+# matplotlib (Utils_Plotting) and ete3 are imported only when the covering is drawn
+# or the tree is built, so the solver needs neither of them nor a display
 
 class Box(object):
     def __init__(self, cpoint, sides):
@@ -57,7 +61,15 @@ class Box(object):
     def getBounds(self):
         return np.copy(self.__bnds)
 
+    def getCenter(self):
+        return self.__cpoint + self.__sides/2.0
+
+    def getIntervals(self):
+        # The intervals of all of the dimensions
+        return tuple(interval[lo, hi] for lo, hi in self.__bnds)
+
     def getInterval(self):
+        # The intervals of the first two dimensions (x, y), see getIntervals
         bnds = np.copy(self.__bnds)
         xmin = bnds[0][0]
         xmax = bnds[0][1]
@@ -68,12 +80,119 @@ class Box(object):
     def __str__(self):
         return '<Box: {}, {}>'.format(self.__cpoint, self.__sides)
 
+def splitBoxes(corners, sides, dims=None, fractions=None):
+    # Vectorized version of Box.Split for a whole level of boxes:
+    # every box is bisected by its longest side and the two children
+    # of a box are stored next to each other (left, right).
+    # The side dims[n] of the n-th box is cut at fractions[n] of it if they are given
+    nBoxes, nDim = corners.shape
+    rows = np.arange(nBoxes)
+    # Find an index of the longest side
+    idx = np.argmax(sides, axis=1) if dims is None else dims
+    if fractions is None:
+        lSide = sides[rows, idx]/2.0
+        rSide = lSide
+    else:
+        lSide = sides[rows, idx]*fractions
+    # To get the first boxes
+    lCorners = np.copy(corners)
+    lSides = np.copy(sides)
+    lSides[rows, idx] = lSide
+    # To get the second ones
+    rCorners = np.copy(corners)
+    rCorners[rows, idx] = rCorners[rows, idx] + lSide
+    if fractions is not None:
+        # The second box ends where the box does whatever the rounding of its corner is
+        rSide = (corners + sides)[rows, idx] - rCorners[rows, idx]
+    rSides = np.copy(sides)
+    rSides[rows, idx] = rSide
+    # Return the obtained boxes
+    cCorners = np.empty((2*nBoxes, nDim))
+    cSides = np.empty((2*nBoxes, nDim))
+    cCorners[0::2] = lCorners
+    cCorners[1::2] = rCorners
+    cSides[0::2] = lSides
+    cSides[1::2] = rSides
+    return cCorners, cSides
+
+def loadNodes(fName, mmap=True):
+    # Read the arrays of a covering saved by CoveringTree.SaveSolution(fName, asArrays=True)
+    # or by a checkpoint without building a CoveringTree object
+    # The previous version is left if a failure happened while replacing it
+    if not os.path.isdir(fName) and os.path.isdir(fName + '.old'):
+        fName = fName + '.old'
+    with open(os.path.join(fName, 'covering.json')) as f:
+        header = json.load(f)
+    mmapMode = 'r' if mmap else None
+    nodes = dict((fileName[len('nodes_'):-len('.npy')], \
+                  np.load(os.path.join(fName, fileName), mmap_mode=mmapMode)) \
+                 for fileName in os.listdir(fName) if fileName.startswith('nodes_'))
+    # The frontier of an unfinished run
+    header['frontier'] = None
+    if header['nextLevel'] is not None:
+        header['frontier'] = tuple(np.load(os.path.join(fName, 'frontier_{}.npy'.format(key))) \
+                                   for key in ('corner', 'sides', 'parent'))
+        # The constraints proved to hold on the parents of the boxes (see CoveringTree.evaluateConstraints)
+        satisfiedName = os.path.join(fName, 'frontier_satisfied.npy')
+        header['frontier'] = header['frontier'] + (np.load(satisfiedName) if os.path.isfile(satisfiedName) else None,)
+    return nodes, header
+
+def getMemoryUsage():
+    # The current resident set size of the process in bytes,
+    # the peak one where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        try:
+            import resource
+        except ImportError:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def getChildren(parents):
+    # The children of a box are stored next to each other in the arrays of a covering,
+    # so it is enough to know the first child of every box and the number of the children
+    firstChild = np.full(parents.shape[0], -1, dtype=np.int64)
+    nChildren = np.zeros(parents.shape[0], dtype=np.int64)
+    uniq, first, counts = np.unique(parents[1:], return_index=True, return_counts=True)
+    firstChild[uniq] = first + 1
+    nChildren[uniq] = counts
+    return firstChild, nChildren
+
+def _getBounds(value):
+    # An interval (or a pair) becomes its hull [lo, hi]
+    if isinstance(value, interval):
+        return value[0][0], value[-1][1]
+    return value[0], value[1]
+
+# The covering whose boxes are evaluated by a worker process
+_oWorkerCovering = None
+
+def _initWorker(oCovering):
+    global _oWorkerCovering
+    _oWorkerCovering = oCovering
+
+def _evaluateShard(shard):
+    # Only the compact arrays of the boxes are exchanged with the workers
+    corners, sides, satisfied = shard
+    return _oWorkerCovering.evaluateConstraints(corners, sides, satisfied)
+
 class CoveringTree(object):
 ############################################################################################
 # Constructor
 ############################################################################################
     __metaclass__ = abc.ABCMeta
     def __init__(self, iBox, idelta=0.0, ShowCovPrc=False, ieps=0.0):
+        # A subclass gives the enclosures box by box (getMinMaxVal), for a batch of boxes (getMinMaxVals)
+        # or the list of its constraints (getConstraints or getBatchConstraints, see evaluateConstraints)
+        if not self.__hasEnclosures():
+            raise TypeError("Can't instantiate {} without getMinMaxVal, getMinMaxVals, getConstraints "
+                            "or getBatchConstraints".format(type(self).__name__))
+        # The gradient encloses one function, so it could not tighten the enclosures of several constraints
+        if any(name in dir(self) for name in ('getConstraints', 'getBatchConstraints')) and \
+           any(name in dir(self) for name in ('getGradient', 'getGradients')):
+            raise TypeError("Can't instantiate {} with both the constraints and the gradient".format(type(self).__name__))
         # Initialize initial Space where the workspace lie
         self.__Xspace = iBox
         # Initialize the minimal size of the rectangle
@@ -85,9 +204,40 @@ class CoveringTree(object):
         # Number of processed levels of the tree and the number of iterations
         self.__nLevelsProcessed = None
         self.__nIterations = None
+        # The covering is stored level by level as flat arrays,
+        # the ete3 tree is built from them on demand only
+        self.__levels = []
+        self.__nodes = None
+        self.__sTree = None
+        # The covering refineSolution starts from
+        self.__previous = None
+        # The cache of the enclosures (see Utils_Cache)
+        self.__oCache = None
+        # The statistics of the processed levels and the functions called after every level
+        self.__bQuiet = False
+        self.__callbacks = []
+        self.__stats = []
+        self.__tEval = 0.0
+        self.__nEvaluated = 0
+        # The tighter enclosures used if a subclass gives the enclosures of the gradient
+        self.__bMeanValue = True
+        self.__bMonotonicity = True
+        # How the boxes are split (see setSplitPolicy)
+        self.__sDirection = 'longest'
+        self.__sPosition = 'middle'
+        self.__nSections = 1
+        self.__minFraction = 0.1
+        self.__maxAspect = 10.0
+        # The budget of a run (the deadline, the time and the number of the boxes) and what has stopped it
+        self.__budget = (None, None, None)
+        self.__sStop = None
+        # The number of the boxes every constraint (see evaluateConstraints) has been evaluated on,
+        # discarded and proved to hold on, and the time of its evaluations by the last run and by all
+        # of the runs; the latter sort the constraints
+        self.__constraintStats = None
+        self.__constraintHistory = None
 
-    @abc.abstractmethod
-    def getMinMaxVal(self, bounds, diam):
+    def getMinMaxVal(self, iBox):
         raise NotImplementedError
 
 ############################################################################################
@@ -99,145 +249,912 @@ class CoveringTree(object):
         return self.__nLevelsProcessed
     def getResIterations(self):
         return self.__nIterations
+    def getResBudgetExceeded(self):
+        # 'time' or 'boxes' if the last run has been stopped by its budget, None otherwise
+        return self.__sStop
+
+    def setCache(self, oCache):
+        # A MinMaxCache or a DiskMinMaxCache of the enclosures, None to switch it off
+        self.__oCache = oCache
+    def getCache(self):
+        return self.__oCache
+
+    def setEnclosureForms(self, meanValue=True, monotonicity=True):
+        # A subclass that encloses the gradient of the constraint with getGradient(iBox)
+        # (the list of the intervals of the partial derivatives) or getGradients(bounds, diams)
+        # (an array of the shape (N, dim, 2)) gets the enclosures of getMinMaxVal(s) tightened by
+        # - the mean-value form f(c) + sum(G_i*(X_i - c_i)) with the center c of the box;
+        # - the monotonicity test: if f is monotone in x_i, only the faces of the box where
+        #   the minimum and the maximum are could be taken.
+        # A subclass that gives the list of its constraints (see evaluateConstraints) could not enclose the gradient
+        self.__bMeanValue = meanValue
+        self.__bMonotonicity = monotonicity
+
+    def setSplitPolicy(self, direction='longest', position='middle', k=1, minFraction=0.1, maxAspect=10.0):
+        # How the boxes that could not be classified are split:
+        # - direction 'longest' takes the longest sides of a box, 'width' takes the sides of
+        #   the variables contributing the most to the width of the enclosure: |G_i|*side_i
+        #   if the gradient is given (see setEnclosureForms), otherwise the decrease of
+        #   the width when x_i is fixed at the middle of the box. The sides shorter than
+        #   the longest one over maxAspect are not taken, so the diameters still go to zero;
+        # - position 'middle' bisects the sides, 'zero' cuts a side where the constraint
+        #   crosses zero between the centers of the faces the side ends at, but not closer
+        #   to the faces than minFraction of the side;
+        # - k sides are cut at once, so a box gets 2^k children.
+        # A subclass could define getSplit(corners, sides, minvals, maxvals) instead, which gives
+        # (corners, sides, nChildren) of the children with the children of a box next to each other
+        if direction not in ('longest', 'width'):
+            raise ValueError('Unknown direction: {}'.format(direction))
+        if position not in ('middle', 'zero'):
+            raise ValueError('Unknown position: {}'.format(position))
+        if k < 1 or not 0.0 < minFraction <= 0.5 or maxAspect < 1.0:
+            raise ValueError('k should be positive, minFraction should be in (0, 0.5] and maxAspect should be 1 or more')
+        self.__sDirection = direction
+        self.__sPosition = position
+        self.__nSections = int(k)
+        self.__minFraction = minFraction
+        self.__maxAspect = maxAspect
+    def getSplitPolicy(self):
+        return self.__sDirection, self.__sPosition, self.__nSections, self.__minFraction, self.__maxAspect
+
+    def setQuiet(self, bQuiet=True):
+        # Do not print the progress, e.g. for the batch runs
+        self.__bQuiet = bQuiet
+    def isQuiet(self):
+        return self.__bQuiet
+
+    def addCallback(self, callback):
+        # callback(stats) is called after every processed level with the statistics
+        # of the level (see getStatistics), e.g. to show the progress
+        self.__callbacks.append(callback)
+    def removeCallback(self, callback):
+        self.__callbacks.remove(callback)
+
+    def getStatistics(self):
+        # The statistics of the levels processed by the last run, one dict per level:
+        # - 'boxes' is the number of the boxes of the level and 'evaluated' is the number of them
+        #   whose enclosures have been obtained from getMinMaxVal(s), not from the cache or
+        #   the previous covering;
+        # - 'inQI', 'inQE', 'discarded' (out of range), 'split' and 'undecided' (left at maxLevels);
+        # - 'evalTime' is the wall time in getMinMaxVal(s), 'drawTime' is the time of drawing
+        #   and 'engineTime' is the rest of the 'time' of the level;
+        # - 'memory' is the memory used by the process after the level in bytes
+        return list(self.__stats)
+
+    def getConstraintStatistics(self):
+        # The statistics of the constraints in the order of getConstraints()/getBatchConstraints()
+        # for the last run, the evaluations made by the worker processes are not counted
+        if self.__constraintStats is None:
+            return []
+        return [{'evaluated': int(nEval), 'discarded': int(nRej), 'satisfied': int(nSat), 'time': float(tEval)} \
+                for nEval, nRej, nSat, tEval in self.__constraintStats.T]
+
+    def getReport(self):
+        # The structured report of the last run
+        totals = {}
+        for key in ('boxes', 'evaluated', 'inQI', 'inQE', 'discarded', 'undecided', \
+                    'evalTime', 'drawTime', 'engineTime', 'time'):
+            totals[key] = sum(stats[key] for stats in self.__stats)
+        totals['memory'] = max([stats['memory'] for stats in self.__stats] or [None])
+        report = {'iBox': {'corner': self.__Xspace.getCorner().tolist(), 'sides': self.__Xspace.getSides().tolist()},
+                  'iDelta': float(self.__delta), 'iEps': float(self.__eps),
+                  'nLevelsProcessed': self.__nLevelsProcessed, 'nIterations': self.__nIterations,
+                  'totals': totals, 'levels': self.getStatistics(),
+                  'budget': {'maxTime': self.__budget[1], 'maxBoxes': self.__budget[2], 'exceeded': self.__sStop}}
+        if self.getNodes() is not None:
+            report['volumes'] = self.getVolumes()
+        if self.__constraintStats is not None:
+            report['constraints'] = self.getConstraintStatistics()
+        if self.__oCache is not None:
+            report['cache'] = self.__oCache.getStatistics()
+        return report
 
-    def getSolution(self, maxLevels):
+    def SaveReport(self, fName):
+        with open(fName, 'w') as outfile:
+            json.dump(self.getReport(), outfile, indent=1)
 
+    def getSolution(self, maxLevels, workers=None, checkpoint=None, checkpointEvery=1, compact=False, \
+                    maxTime=None, maxBoxes=None):
+        # The run is stopped before a level that would take it over maxTime seconds or over
+        # maxBoxes processed boxes (iterations); the boxes of the level are left in the boundary
+        # (inQE) without being evaluated, so the covering is still valid (see getVolumes)
         # Initialize the Root of the Tree and additional variables
-        self.__initTree(self.__Xspace)
+        frontier = self.__initTree(self.__Xspace)
+        self.__stats = []
         # Uncomment if it necessary to get information on the initial box
         # print 'The diameter of the initial box is {}'.format(self.__Xspace.getDiam())
+        self.__runSolution(maxLevels, frontier, 0, 0, workers, checkpoint, checkpointEvery, maxTime, maxBoxes)
+        if compact:
+            self.compactSolution()
+
+    def resumeSolution(self, fName, maxLevels, workers=None, checkpointEvery=1, maxTime=None, maxBoxes=None):
+        # Continue the run saved by getSolution(..., checkpoint=fName)
+        # and keep on saving the checkpoints to the same place
+        frontier, startLevel, nIter = self.__loadArrays(fName, False)
+        self.__stats = []
+        if frontier is not None:
+            self.__runSolution(maxLevels, frontier, startLevel, nIter, workers, fName, checkpointEvery, \
+                               maxTime, maxBoxes)
+
+    def getVolumes(self):
+        # The volumes of the inner approximation (inQI), of the boundary (inQE and the boxes
+        # left undecided) and of the excluded boxes, and their parts of the initial box
+        leaves = self.getLeaves()
+        volumes = np.prod(np.asarray(leaves['sides'], dtype=float), axis=1)
+        inner = np.asarray(leaves['inQI'], dtype=bool)
+        boundary = np.logical_and(np.logical_not(inner), np.logical_or(leaves['inQE'], leaves['cont']))
+        excluded = np.logical_not(np.logical_or(inner, boundary))
+        res = {'total': float(np.prod(self.__Xspace.getSides()))}
+        for key, mask in (('inner', inner), ('boundary', boundary), ('excluded', excluded)):
+            res[key] = float(np.sum(volumes[mask]))
+            res[key + 'Part'] = res[key]/res['total'] if res['total'] > 0 else 0.0
+        return res
+
+    def __runSolution(self, maxLevels, frontier, startLevel, nIter, workers, checkpoint, checkpointEvery, \
+                      maxTime=None, maxBoxes=None):
+        self.__budget = (None if maxTime is None else time.time() + maxTime, maxTime, maxBoxes)
+        self.__sStop = None
+        self.__constraintStats = None
+        # The boxes of a level are independent, so they could be evaluated
+        # by a pool of worker processes
+        oPool = None
+        if workers is not None and workers > 1:
+            oPool = multiprocessing.Pool(workers, initializer=_initWorker, initargs=(self,))
+        try:
+            self.__getSolution(maxLevels, frontier, startLevel, nIter, oPool, workers, \
+                               checkpoint, checkpointEvery)
+        finally:
+            if oPool is not None:
+                oPool.close()
+                oPool.join()
+
+    def __getSolution(self, maxLevels, frontier, startLevel, nIter, oPool, nWorkers, \
+                      checkpoint, checkpointEvery):
+
+        # The frontier keeps the constraints proved to hold on the parents of the boxes
+        corners, sides, parents, satisfied = frontier
         bExit = False
-        nIter = 0
+        # The boxes of the previous covering the boxes of the frontier coincide with
+        oldIds = None
+        if self.__previous is not None and startLevel == 0:
+            oldIds = np.zeros(1, dtype=np.int64)
+        # The time of a box on the previous level to foresee the time of the next one
+        tPerBox = 0.0
 
-        for curLevel in range(0, maxLevels):
-            # Get all the rectangles that are on some level of the tree
-            curLevelNodes = self.__sTree.get_leaves_by_name(name='{}'.format(curLevel))
+        for curLevel in range(startLevel, maxLevels):
+            # All of the boxes have been classified on the previous levels
+            if corners.shape[0] == 0:
+                self.__nLevelsProcessed = curLevel - 1
+                self.__nIterations = nIter
+                break
+            tLevel = time.time()
+            self.__tEval = 0.0
+            self.__nEvaluated = 0
+            nBoxes = corners.shape[0]
+            diams = np.sqrt(np.sum(sides*sides, axis=1))
+            # There is no budget for the level, so its boxes are left in the boundary
+            sStop = self.__getBudgetExceeded(nIter, nBoxes, tPerBox)
+            if sStop is not None:
+                self.__stopLevel(corners, sides, parents, curLevel, diams, tLevel, sStop)
+                self.__nLevelsProcessed = curLevel - 1
+                self.__nIterations = nIter
+                break
             # Uncomment if you would like to see the progress of calculation for every level
-            print 'The {}th layer of boxes with the diameter equals {} is precessed'.format(curLevel, \
-                    curLevelNodes[0].Box.getDiam())
-            # Loop over the rectangles
-            for curLevelNode in curLevelNodes:
-                nIter = nIter + 1
-                #Get a box from the tree level
-                oBox = curLevelNode.Box
-                #Analyze it
-                cont, inrange = self.__analyseBox(oBox)
-                #Classify it
-                inQE, inQI, bExit = self.__placeBox(oBox, cont, inrange)
-                #Save the obtained results
-                if cont and (curLevel < maxLevels-1) and not bExit:
-                    # (oRleft, oRright) = self.__getNewRect(oRect, curLevel)
-                    (oRleft, oRright) = oBox.Split()
-                    self.__addToTree(curLevelNode, oRleft, oRright, curLevel + 1)
-                else:
-                    #save results to the analyzed node
-                    curLevelNode.add_feature('Inrange', inrange)
-                    curLevelNode.add_feature('inQI', inQI)
-                    curLevelNode.add_feature('inQE', inQE)
-                #Draw the coveing process
-                if self.__bShow:
-                    # Call a method from CableCon2017_Plotting.py,
-                    # which must be in self after calling PlottingTree.__init__(...)
-                    if 'drawBox' in dir(self):
-                        self.drawBox(oBox, inrange, inQI, inQE)
+            if not self.__bQuiet:
+                print 'The {}th layer of boxes with the diameter equals {} is precessed'.format(curLevel, \
+                        np.max(diams))
+            nIter = nIter + nBoxes
+            #Analyze the whole level at once
+            minvals, maxvals, satisfied, exact = self.__reuseLevel(corners, sides, satisfied, oldIds, oPool, nWorkers)
+            cont, inrange = self.__analyseBoxes(minvals, maxvals)
+            #Classify it
+            inQE, inQI, small = self.__placeBoxes(diams, cont, inrange)
+            #Draw the coveing process
+            tDraw = time.time()
+            if self.__bShow:
+                # Call a method from CableCon2017_Plotting.py,
+                # which must be in self after calling PlottingTree.__init__(...)
+                if 'drawLeaves' in dir(self):
+                    # The whole level at once
+                    self.drawLeaves({'corner': corners, 'sides': sides, 'inQI': inQI, 'inQE': inQE})
+                elif 'drawBox' in dir(self):
+                    for idx in range(nBoxes):
+                        self.drawBox(Box(corners[idx], sides[idx]), inrange[idx], inQI[idx], inQE[idx])
+            tDraw = time.time() - tDraw
+            #Save the obtained results
+            split = cont & np.logical_not(small)
+            if curLevel == maxLevels-1:
+                split[:] = False
+            # The boxes of a level could have different diameters, so the small boxes
+            # are placed one by one and the run stops when no box is left to split
+            bExit = small.any() and not split.any()
+            # The covering keeps only the enclosures that do not depend on eps, the rest are unknown (NaN)
+            ids = self.__addToTree(corners, sides, parents, curLevel, split, inrange, cont, inQI, inQE, \
+                                   np.where(exact, minvals, np.nan), np.where(exact, maxvals, np.nan))
+            # Bisect the boxes that should be processed further
+            corners, sides, nChildren = self.__splitBoxes(corners[split], sides[split], minvals[split], \
+                                                          maxvals[split], oPool, nWorkers)
+            parents = np.repeat(ids[split], nChildren)
+            if satisfied is not None:
+                satisfied = np.repeat(satisfied[split], nChildren, axis=0)
+            if oldIds is not None:
+                oldIds = self.__getPreviousChildren(oldIds[split], nChildren, corners, sides)
+            #Save the progress to resume the run in case of a failure
+            bLast = bExit or curLevel == maxLevels-1 or corners.shape[0] == 0
+            if checkpoint is not None and not bLast and (curLevel + 1 - startLevel) % checkpointEvery == 0:
+                self.__saveArrays(checkpoint, (corners, sides, parents, satisfied), curLevel + 1, nIter)
+            self.__addStatistics(curLevel, diams, split, inrange, cont, inQI, inQE, \
+                                 time.time() - tLevel, tDraw)
+            tPerBox = (time.time() - tLevel)/nBoxes
             #All of the rectangles could be obtained on the next iterations are too small
             #so break it
             if bExit:
                 # Uncomment if you would like to get information on the processed levels
                 # and iterations
-                print 'Number of levels were processed: {}'.format(curLevel)
-                print 'Number of iterations: {}'.format(nIter)
+                if not self.__bQuiet:
+                    print 'Number of levels were processed: {}'.format(curLevel)
+                    print 'Number of iterations: {}'.format(nIter)
                 self.__nLevelsProcessed = curLevel
                 self.__nIterations = nIter
                 if self.__bShow:
+                    import matplotlib.pyplot as plt
                     plt.show()
                 break
+        if checkpoint is not None:
+            self.__saveArrays(checkpoint)
+
+    def iterSolution(self, maxLevels, strategy='depth'):
+        # Explore the boxes one by one and yield every classified box as
+        # (corner, sides, inQI, inQE) as soon as it is placed.
+        # The covering is not kept: the depth-first strategy needs O(depth) memory,
+        # the best-first one processes the largest boxes first (coarse to fine)
+        if strategy not in ('depth', 'best'):
+            raise ValueError('Unknown strategy: {}'.format(strategy))
+        nIter = 1
+        nDeepest = 0
+        bTruncated = False
+        corners = np.array([self.__Xspace.getCorner()], dtype=float)
+        sides = np.array([self.__Xspace.getSides()], dtype=float)
+        minvals, maxvals, satisfied, exact = self.__evaluateLevel(corners, sides, None, None, None)
+        # The entries are (priority, order, corner, sides, level, minval, maxval, satisfied)
+        boxes = [(0.0, 0, corners[0], sides[0], 0, minvals[0], maxvals[0], \
+                  None if satisfied is None else satisfied[0])]
+        while boxes:
+            if strategy == 'depth':
+                entry = boxes.pop()
+            else:
+                entry = heapq.heappop(boxes)
+            corner, side, curLevel, minval, maxval, satisfied = entry[2:]
+            nDeepest = max(nDeepest, curLevel)
+            diams = np.array([sqrt(np.sum(side*side))])
+            cont, inrange = self.__analyseBoxes(np.array([minval]), np.array([maxval]))
+            inQE, inQI, small = self.__placeBoxes(diams, cont, inrange)
+            if cont[0] and not small[0] and curLevel < maxLevels-1:
+                # Evaluate both of the children at once
+                cCorners, cSides, nChildren = self.__splitBoxes(corner.reshape(1, -1), side.reshape(1, -1), \
+                                                                np.array([minval]), np.array([maxval]), None, None)
+                if satisfied is not None:
+                    satisfied = np.repeat(satisfied[np.newaxis], cCorners.shape[0], axis=0)
+                cMinvals, cMaxvals, cSatisfied, cExact = self.__evaluateLevel(cCorners, cSides, satisfied, None, None)
+                # The first child is on the top of the stack
+                for idx in reversed(range(cCorners.shape[0])):
+                    nIter = nIter + 1
+                    child = (-sqrt(np.sum(cSides[idx]*cSides[idx])), nIter, cCorners[idx], cSides[idx], \
+                             curLevel + 1, cMinvals[idx], cMaxvals[idx], None if cSatisfied is None else cSatisfied[idx])
+                    if strategy == 'depth':
+                        boxes.append(child)
+                    else:
+                        heapq.heappush(boxes, child)
+            else:
+                bTruncated = bTruncated or (cont[0] and not small[0])
+                yield corner, side, inQI[0], inQE[0]
+        # The same results as getSolution provides
+        if not bTruncated:
+            self.__nLevelsProcessed = nDeepest
+            self.__nIterations = nIter
+
+    def evaluateBoxes(self, corners, sides):
+        # Get the enclosures of the constraints over a batch of boxes,
+        # the list of the constraints of a subclass is evaluated as it is (see evaluateConstraints)
+        if self.__getConstraintFuncs() is not None:
+            return self.evaluateConstraints(corners, sides)[:2]
+        minvals, maxvals = self.__getMinMaxVals(corners, sides)
+        if (self.__bMeanValue or self.__bMonotonicity) and corners.shape[0]:
+            # All of the boxes are tightened whatever eps is, so the enclosures kept by the covering
+            # and the cache could be reused by refineSolution for another eps
+            gradients = self.__getGradients(corners, sides)
+            if gradients is not None:
+                minvals, maxvals = self.__tightenEnclosures(corners, sides, minvals, maxvals, gradients)
+        return minvals, maxvals
+
+    def evaluateConstraints(self, corners, sides, satisfied=None):
+        # A subclass could give the list of its constraints g_j(x) <= 0 instead of reducing them
+        # to one enclosure in getMinMaxVal: getConstraints() gives the functions g_j(iBox) -> (min, max)
+        # and getBatchConstraints() gives the vectorized ones g_j(bounds, diams) -> (minvals, maxvals).
+        # The constraints are evaluated one by one over the boxes that are not decided yet:
+        # - a box is discarded as soon as the min of a constraint is above eps, the rest of
+        #   the constraints are not evaluated on it (its max becomes inf);
+        # - a constraint whose max is below -eps holds on the box and its children, so they
+        #   skip it. satisfied keeps these maxima (NaN for the rest), one row per box;
+        # - the constraints that discard more boxes per second go first.
+        # The enclosures of the constraints are not tightened (see setEnclosureForms). The ones obtained by
+        # skipping or discarding depend on eps, so they are not cached and the covering keeps them as NaN.
+        # The results are the enclosures of max_j g_j and the satisfied rows of the boxes
+        return self.__evaluateConstraints(corners, sides, satisfied, True)
+
+    def refineSolution(self, maxLevels, idelta=None, ieps=None, workers=None, checkpoint=None, \
+                       checkpointEvery=1, maxTime=None, maxBoxes=None):
+        # Get the covering for a smaller delta (or another eps) from the obtained one:
+        # the enclosures of the boxes it has are reused and only the rest of the boxes,
+        # mostly the inQE ones, are evaluated. The result is the same as for getSolution
+        nodes = self.getNodes()
+        firstChild, nChildren = getChildren(np.asarray(nodes['parent']))
+        self.__previous = {'corner': nodes['corner'], 'sides': nodes['sides'],
+                           'minval': nodes['minval'], 'maxval': nodes['maxval'],
+                           'firstChild': firstChild, 'nChildren': nChildren}
+        if idelta is not None:
+            self.__delta = idelta
+        if ieps is not None:
+            self.__eps = ieps
+        self.__nLevelsProcessed = None
+        self.__nIterations = None
+        try:
+            self.getSolution(maxLevels, workers, checkpoint, checkpointEvery, maxTime=maxTime, maxBoxes=maxBoxes)
+        finally:
+            self.__previous = None
+
+    def compactSolution(self):
+        # Merge the children of a box back into it if all of them are leaves
+        # of the same class, either in range (inQI) or out of range.
+        # The boundary boxes are kept as they are, so the geometry of the covering
+        # does not change. Return the number of the removed boxes
+        nodes = self.getNodes()
+        nodes = dict((key, np.array(nodes[key])) for key in nodes)
+        nRemoved = 0
+        while nodes['parent'].shape[0] > 1:
+            firstChild, nChildren = getChildren(nodes['parent'])
+            # The code of the class of a box, the decided leaves are below 8
+            codes = nodes['inrange']*1 + nodes['inQI']*2 + nodes['inQE']*4 + nodes['cont']*8 + nodes['split']*16
+            parents = np.nonzero(nChildren)[0]
+            starts = firstChild[parents] - 1
+            minCodes = np.minimum.reduceat(codes[1:], starts)
+            maxCodes = np.maximum.reduceat(codes[1:], starts)
+            merged = parents[np.logical_and(minCodes == maxCodes, maxCodes < 8)]
+            if merged.shape[0] == 0:
+                break
+            # The merged boxes get the class of their children
+            children = firstChild[merged]
+            for key in ('inrange', 'inQI', 'inQE', 'cont'):
+                nodes[key][merged] = nodes[key][children]
+            nodes['split'][merged] = False
+            keep = np.ones(nodes['parent'].shape[0], dtype=bool)
+            keep[np.repeat(children, nChildren[merged]) + \
+                 np.arange(np.sum(nChildren[merged])) - np.repeat(np.cumsum(nChildren[merged]) - \
+                                                                 nChildren[merged], nChildren[merged])] = False
+            # The order of the rest of the boxes is kept, so their children are still next to each other
+            newIds = np.cumsum(keep) - 1
+            nodes = dict((key, nodes[key][keep]) for key in nodes)
+            nodes['parent'] = np.where(nodes['parent'] >= 0, newIds[np.maximum(nodes['parent'], 0)], -1)
+            nRemoved = nRemoved + np.sum(np.logical_not(keep))
+        self.__nodes = nodes
+        self.__levels = [nodes]
+        self.__sTree = None
+        return nRemoved
+
+    def getNodes(self):
+        # All the boxes of the covering in the level order:
+        # the children of a box are stored next to each other and
+        # 'parent' is the index of the box they were obtained from
+        if self.__nodes is None:
+            if self.__levels:
+                self.__nodes = dict((key, np.concatenate([lvl[key] for lvl in self.__levels])) \
+                                    for key in self.__levels[0])
+                self.__levels = [self.__nodes]
+            elif self.__sTree is not None:
+                self.__nodes = self.__getNodesFromTree(self.__sTree)
+        return self.__nodes
+
+    def getLeaves(self):
+        # The classified boxes of the covering as compact arrays
+        nodes = self.getNodes()
+        leaves = np.logical_not(nodes['split'])
+        return dict((key, nodes[key][leaves]) for key in nodes if key not in ('parent', 'split'))
 
     def getTree(self):
+        if self.__sTree is None and self.getNodes() is not None:
+            self.__sTree = self.__buildTree(self.getNodes())
         T = {'iBox': self.__Xspace, 'iDelta': self.__delta,
              'iEps': self.__eps, 'bShow': self.__bShow, 'Tree': self.__sTree}
         return T
 
-    def SaveSolution(self, fName):
+    def SaveSolution(self, fName, asArrays=False):
+        # The arrays are saved to the fName directory as .npy files
+        if asArrays:
+            self.__saveArrays(fName)
+            return
         T = self.getTree()
         cPickle.dump(T, open(fName, 'wb'))
 
     def isFileExist(self, fName):
-        return os.path.isfile(fName)
+        return os.path.isfile(fName) or os.path.isdir(fName)
 
-    def LoadSolution(self, fName):
+    def LoadSolution(self, fName, mmap=True):
+        # The arrays of a covering saved with asArrays=True are memory-mapped
+        # instead of being read, so there is no need in unpickling millions of objects
+        if os.path.isdir(fName) or os.path.isdir(fName + '.old'):
+            self.__loadArrays(fName, mmap)
+            return
         T = cPickle.load(open(fName, 'rb'))
         self.__setTree(T)
 
 ############################################################################################
 # Private Members
 ############################################################################################
-    def __analyseBox(self, iBox):
+    def __hasEnclosures(self):
+        if type(self).getMinMaxVal.im_func is not CoveringTree.getMinMaxVal.im_func:
+            return True
+        return any(name in dir(self) for name in ('getMinMaxVals', 'getConstraints', 'getBatchConstraints'))
 
-        inrange = False
-        cont = True
+    def __reuseLevel(self, corners, sides, satisfied, oldIds, oPool, nWorkers):
+        if oldIds is None:
+            return self.__evaluateLevel(corners, sides, satisfied, oPool, nWorkers)
+        # Take the enclosures of the boxes evaluated by the previous run
+        # and evaluate the rest of the boxes only
+        known = oldIds >= 0
+        minvals = np.full(corners.shape[0], np.nan)
+        maxvals = np.full(corners.shape[0], np.nan)
+        minvals[known] = self.__previous['minval'][oldIds[known]]
+        maxvals[known] = self.__previous['maxval'][oldIds[known]]
+        unknown = np.logical_not(np.logical_and(np.isfinite(minvals), np.isfinite(maxvals)))
+        exact = np.ones(corners.shape[0], dtype=bool)
+        if unknown.any():
+            uMinvals, uMaxvals, uSatisfied, uExact = self.__evaluateLevel(corners[unknown], sides[unknown], \
+                                                                          None if satisfied is None else satisfied[unknown], \
+                                                                          oPool, nWorkers)
+            minvals[unknown] = uMinvals
+            maxvals[unknown] = uMaxvals
+            exact[unknown] = uExact
+            satisfied = self.__mergeSatisfied(satisfied, unknown, uSatisfied)
+        return minvals, maxvals, satisfied, exact
 
-        # if iBox.getCorner()[0] == -0.125 and iBox.getCorner()[1] == -14.0 and iBox.getSides()[1] == 0.5:
-        #     print iBox
+    def __getPreviousChildren(self, oldIds, nChildren, corners, sides):
+        # The children of the boxes of the previous covering coincide
+        # with the obtained ones if they were split in the same way
+        prev = self.__previous
+        first = np.repeat(np.where(oldIds >= 0, prev['firstChild'][np.maximum(oldIds, 0)], -1), nChildren)
+        nPrevChildren = np.repeat(prev['nChildren'][np.maximum(oldIds, 0)], nChildren)
+        children = first + np.arange(corners.shape[0]) - np.repeat(np.cumsum(nChildren) - nChildren, nChildren)
+        valid = np.logical_and(first >= 0, nPrevChildren == np.repeat(nChildren, nChildren))
+        checked = np.where(valid, children, 0)
+        valid = valid & np.all(prev['corner'][checked] == corners, axis=1) \
+                      & np.all(prev['sides'][checked] == sides, axis=1)
+        return np.where(valid, children, -1)
 
-        # Call an abstract method
-        minval, maxval = self.getMinMaxVal(iBox)
-        #The whole rectangle is a part of the solution -> save it
-        if maxval < -self.__eps:
-            #mark it as in range
-            inrange = True
-            cont = False
-            return cont, inrange
+    def __getMinMaxVals(self, corners, sides):
+        if 'getMinMaxVals' in dir(self):
+            # A subclass provides the vectorized version:
+            # getMinMaxVals(bounds, diams) with bounds of the shape (N, dim, 2)
+            bounds = np.stack((corners, corners + sides), axis=2)
+            diams = np.sqrt(np.sum(sides*sides, axis=1))
+            minvals, maxvals = self.getMinMaxVals(bounds, diams)
+            return np.array(minvals, dtype=float), np.array(maxvals, dtype=float)
+        # Otherwise call an abstract method for every box
+        minvals = np.empty(corners.shape[0])
+        maxvals = np.empty(corners.shape[0])
+        for idx in range(corners.shape[0]):
+            minvals[idx], maxvals[idx] = self.getMinMaxVal(Box(corners[idx], sides[idx]))
+        return minvals, maxvals
 
-        #There is no solution for the rectangle -> get rid of it
-        if minval > self.__eps:
-            #mark it as out of range
-            inrange = False
-            cont = False
-            return cont, inrange
+    def __getGradients(self, corners, sides):
+        # The enclosures of the gradient as an array of the shape (N, dim, 2), None if there are none
+        if 'getGradients' in dir(self):
+            bounds = np.stack((corners, corners + sides), axis=2)
+            diams = np.sqrt(np.sum(sides*sides, axis=1))
+            return np.asarray(self.getGradients(bounds, diams), dtype=float)
+        if 'getGradient' in dir(self):
+            return np.array([[_getBounds(grad) for grad in self.getGradient(Box(corners[idx], sides[idx]))] \
+                             for idx in range(corners.shape[0])], dtype=float).reshape(corners.shape + (2,))
+        return None
 
-        #The rectangle should be processed further
-        return cont, inrange
+    def __tightenEnclosures(self, corners, sides, minvals, maxvals, gradients):
+        lower = gradients[:, :, 0]
+        upper = gradients[:, :, 1]
+        if self.__bMonotonicity:
+            # f does not decrease (increase) in x_i over the box, so its minimum is on
+            # the lower (upper) face and its maximum is on the opposite one
+            increasing = lower >= 0
+            decreasing = upper <= 0
+            monotone = np.logical_or(increasing, decreasing)
+            rows = np.nonzero(monotone.any(axis=1))[0]
+            if rows.shape[0]:
+                c = corners[rows]
+                s = sides[rows]
+                faceSides = np.where(monotone[rows], 0.0, s)
+                minCorners = np.where(decreasing[rows], c + s, c)
+                maxCorners = np.where(np.logical_and(increasing[rows], np.logical_not(decreasing[rows])), c + s, c)
+                minvals[rows] = np.maximum(minvals[rows], self.__getMinMaxVals(minCorners, faceSides)[0])
+                maxvals[rows] = np.minimum(maxvals[rows], self.__getMinMaxVals(maxCorners, faceSides)[1])
+        if self.__bMeanValue:
+            # f(X) is in f(c) + sum(G_i*[-r_i, r_i]) with the half sides r_i
+            radius = sides/2.0
+            centerMin, centerMax = self.__getMinMaxVals(corners + radius, np.zeros_like(sides))
+            spread = np.sum(radius*np.maximum(np.abs(lower), np.abs(upper)), axis=1)
+            minvals = np.maximum(minvals, centerMin - spread)
+            maxvals = np.minimum(maxvals, centerMax + spread)
+        return minvals, maxvals
 
-    def __placeBox(self, iBox, cont, inrange):
-        inQE = False
-        inQI = False
-        bExit = False
-        #The diameter of the rectangle is less than or equal to the predefined delta value
-        if iBox.getDiam() <= self.__delta:
-            #It is too small but we have to analyze it before quit
-            if cont:
-                inQI = False
-                inQE = True
-            else:
-                if inrange:
-                    inQI = True
-                    inQE = False
-                #else: defaults
-            #Return the result on the next iteration
-            bExit = True
-        #Otherwise
-        else:
-            if inrange:
-                inQI = True
-                inQE = False
-            #else: defaults
-        return inQE, inQI, bExit
+    def __splitBoxes(self, corners, sides, minvals, maxvals, oPool, nWorkers):
+        # Get the children of the boxes and the number of the children of every box
+        if 'getSplit' in dir(self):
+            cCorners, cSides, nChildren = self.getSplit(corners, sides, minvals, maxvals)
+            return np.asarray(cCorners, dtype=float), np.asarray(cSides, dtype=float), \
+                   np.asarray(nChildren, dtype=np.int64)
+        nBoxes, nDim = corners.shape
+        k = min(self.__nSections, nDim)
+        nChildren = np.full(nBoxes, 2**k, dtype=np.int64)
+        if self.__sDirection == 'longest' and self.__sPosition == 'middle' and k == 1:
+            cCorners, cSides = splitBoxes(corners, sides)
+            return cCorners, cSides, nChildren
+        # The sides to cut in the order of their priority, the first of the equal ones goes first
+        scores = sides
+        if self.__sDirection == 'width':
+            scores = self.__getWidthContributions(corners, sides, minvals, maxvals, oPool, nWorkers)
+            tooShort = sides*self.__maxAspect < np.max(sides, axis=1)[:, np.newaxis]
+            scores = np.where(tooShort, -np.inf, np.nan_to_num(scores))
+        dims = np.argsort(-scores, axis=1, kind='mergesort')[:, :k]
+        fractions = np.full((nBoxes, k), 0.5)
+        if self.__sPosition == 'zero':
+            for jdx in range(k):
+                fractions[:, jdx] = self.__getZeroCrossings(corners, sides, dims[:, jdx], oPool, nWorkers)
+        # Every cut doubles the boxes, the children of a box stay next to each other
+        for jdx in range(k):
+            corners, sides = splitBoxes(corners, sides, np.repeat(dims[:, jdx], 2**jdx), \
+                                        np.repeat(fractions[:, jdx], 2**jdx))
+        return corners, sides, nChildren
+
+    def __getWidthContributions(self, corners, sides, minvals, maxvals, oPool, nWorkers):
+        gradients = self.__getGradients(corners, sides)
+        if gradients is not None:
+            return np.maximum(np.abs(gradients[:, :, 0]), np.abs(gradients[:, :, 1]))*sides
+        # Fix every variable at the middle of the box in turn
+        nBoxes, nDim = corners.shape
+        rows = np.arange(nBoxes*nDim)
+        dims = np.tile(np.arange(nDim), nBoxes)
+        fCorners = np.repeat(corners, nDim, axis=0)
+        fSides = np.repeat(sides, nDim, axis=0)
+        fCorners[rows, dims] = fCorners[rows, dims] + fSides[rows, dims]/2.0
+        fSides[rows, dims] = 0.0
+        fMinvals, fMaxvals = self.__evaluateProbes(fCorners, fSides, oPool, nWorkers)
+        # The fixed boxes are in the boxes, so their enclosures could be taken in the ones of the boxes
+        fMinvals = np.maximum(fMinvals.reshape(nBoxes, nDim), minvals[:, np.newaxis])
+        fMaxvals = np.minimum(fMaxvals.reshape(nBoxes, nDim), maxvals[:, np.newaxis])
+        return (maxvals - minvals)[:, np.newaxis] - (fMaxvals - fMinvals)
+
+    def __getZeroCrossings(self, corners, sides, dims, oPool, nWorkers):
+        # The values at the centers of the faces are interpolated linearly along the side
+        nBoxes = corners.shape[0]
+        rows = np.arange(nBoxes)
+        lower = corners + sides/2.0
+        lower[rows, dims] = corners[rows, dims]
+        upper = np.copy(lower)
+        upper[rows, dims] = corners[rows, dims] + sides[rows, dims]
+        minvals, maxvals = self.__evaluateProbes(np.concatenate((lower, upper)), \
+                                                 np.zeros((2*nBoxes, corners.shape[1])), oPool, nWorkers)
+        # The max of a discarded point could be unknown
+        values = np.where(np.isfinite(maxvals), (minvals + maxvals)/2.0, minvals)
+        lValues = values[:nBoxes]
+        uValues = values[nBoxes:]
+        fractions = np.full(nBoxes, 0.5)
+        crossing = lValues*uValues < 0
+        fractions[crossing] = lValues[crossing]/(lValues[crossing] - uValues[crossing])
+        return np.clip(fractions, self.__minFraction, 1.0 - self.__minFraction)
+
+    def __evaluateProbes(self, corners, sides, oPool, nWorkers):
+        # The faces and the points the split policy looks at are not boxes of the covering,
+        # so they are not cached and not counted in the statistics of the level and of the constraints
+        return self.__evaluateInPool(corners, sides, None, oPool, nWorkers, False)[:2]
+
+    def __evaluateLevel(self, corners, sides, satisfied, oPool, nWorkers):
+        if self.__oCache is None:
+            return self.__evaluateShards(corners, sides, satisfied, oPool, nWorkers)
+        # The cache is used by the main process only, so the workers get the missed boxes only.
+        # The boxes found keep the constraints satisfied on their parents
+        bounds = np.stack((corners, corners + sides), axis=2)
+        found, minvals, maxvals = self.__oCache.lookup(bounds)
+        missed = np.logical_not(found)
+        exact = np.ones(corners.shape[0], dtype=bool)
+        if missed.any():
+            mMinvals, mMaxvals, mSatisfied, mExact = self.__evaluateShards(corners[missed], sides[missed], \
+                                                                           None if satisfied is None else satisfied[missed], \
+                                                                           oPool, nWorkers)
+            minvals[missed] = mMinvals
+            maxvals[missed] = mMaxvals
+            exact[missed] = mExact
+            satisfied = self.__mergeSatisfied(satisfied, missed, mSatisfied)
+            stored = np.nonzero(missed)[0][mExact]
+            self.__oCache.store(bounds[stored], minvals[stored], maxvals[stored])
+        return minvals, maxvals, satisfied, exact
 
     @staticmethod
-    def __addToTree(motherNode, iBox1, iBox2, childNodeLevel):
-        # and add the nodes as children.
-        oNode2 = motherNode.add_child(name='{}'.format(childNodeLevel))
-        oNode1 = motherNode.add_child(name='{}'.format(childNodeLevel))
-        #add features
-        oNode2.add_feature('Box', iBox2)
-        oNode1.add_feature('Box', iBox1)
+    def __mergeSatisfied(satisfied, rows, rowsSatisfied):
+        # Put the satisfied constraints of the evaluated rows into the ones of all of the boxes
+        if rowsSatisfied is None:
+            return satisfied
+        if satisfied is None:
+            satisfied = np.full((rows.shape[0], rowsSatisfied.shape[1]), np.nan)
+        satisfied = np.array(satisfied, dtype=float)
+        satisfied[rows] = rowsSatisfied
+        return satisfied
+
+    def __evaluateShards(self, corners, sides, satisfied, oPool, nWorkers):
+        # The time of the evaluation is the wall time of the main process,
+        # so it includes the exchange with the workers
+        tStart = time.time()
+        try:
+            minvals, maxvals, eSatisfied = self.__evaluateInPool(corners, sides, satisfied, oPool, nWorkers)
+        finally:
+            self.__tEval = self.__tEval + time.time() - tStart
+            self.__nEvaluated = self.__nEvaluated + corners.shape[0]
+        return minvals, maxvals, eSatisfied, self.__getExact(satisfied, maxvals, eSatisfied)
+
+    @staticmethod
+    def __getExact(satisfied, maxvals, eSatisfied):
+        # The enclosures of the boxes that have skipped the constraints held on their parents or have been
+        # discarded before all of their constraints were evaluated depend on eps (see evaluateConstraints),
+        # so neither the cache nor the covering keeps them for the runs with another eps
+        if eSatisfied is None:
+            return np.ones(maxvals.shape[0], dtype=bool)
+        exact = np.isfinite(maxvals)
+        if satisfied is not None:
+            exact = exact & np.all(np.isnan(satisfied), axis=1)
+        return exact
+
+    def __evaluateInPool(self, corners, sides, satisfied, oPool, nWorkers, bCount=True):
+        # There is no need in the workers for the small levels
+        if oPool is None or corners.shape[0] < 2*nWorkers:
+            return self.__evaluateConstraints(corners, sides, satisfied, bCount)
+        # Several shards per worker to balance the load
+        nShards = min(corners.shape[0], 4*nWorkers)
+        shards = zip(np.array_split(corners, nShards), np.array_split(sides, nShards), \
+                     np.array_split(satisfied, nShards) if satisfied is not None else [None]*nShards)
+        results = oPool.map(_evaluateShard, shards, chunksize=1)
+        # The shards are merged in the same order, so the results are the same as for a serial run
+        minvals = np.concatenate([minv for minv, maxv, sat in results])
+        maxvals = np.concatenate([maxv for minv, maxv, sat in results])
+        satisfied = None
+        if results[0][2] is not None:
+            satisfied = np.concatenate([sat for minv, maxv, sat in results])
+        return minvals, maxvals, satisfied
+
+    def __evaluateConstraints(self, corners, sides, satisfied, bCount):
+        funcs = self.__getConstraintFuncs()
+        if funcs is None:
+            minvals, maxvals = self.evaluateBoxes(corners, sides)
+            return minvals, maxvals, None
+        funcs, bBatch = funcs
+        nBoxes = corners.shape[0]
+        if satisfied is None:
+            satisfied = np.full((nBoxes, len(funcs)), np.nan)
+        satisfied = np.array(satisfied, dtype=float)
+        minvals = np.full(nBoxes, -np.inf)
+        maxvals = np.max(np.where(np.isnan(satisfied), -np.inf, satisfied), axis=1) if len(funcs) else \
+                  np.full(nBoxes, -np.inf)
+        active = np.ones(nBoxes, dtype=bool)
+        for jdx in self.__getConstraintOrder(len(funcs)):
+            rows = np.nonzero(np.logical_and(active, np.isnan(satisfied[:, jdx])))[0]
+            if rows.shape[0] == 0:
+                continue
+            tStart = time.time()
+            if bBatch:
+                bounds = np.stack((corners[rows], corners[rows] + sides[rows]), axis=2)
+                diams = np.sqrt(np.sum(sides[rows]*sides[rows], axis=1))
+                lower, upper = funcs[jdx](bounds, diams)
+                lower = np.asarray(lower, dtype=float)
+                upper = np.asarray(upper, dtype=float)
+            else:
+                lower = np.empty(rows.shape[0])
+                upper = np.empty(rows.shape[0])
+                for idx, row in enumerate(rows):
+                    lower[idx], upper[idx] = funcs[jdx](Box(corners[row], sides[row]))
+            rejected = lower > self.__eps
+            holds = upper < -self.__eps
+            if bCount:
+                counts = [rows.shape[0], np.sum(rejected), np.sum(holds), time.time() - tStart]
+                if self.__constraintStats is None or self.__constraintStats.shape[1] != len(funcs):
+                    self.__constraintStats = np.zeros((4, len(funcs)))
+                self.__constraintStats[:, jdx] = self.__constraintStats[:, jdx] + counts
+                self.__constraintHistory[:, jdx] = self.__constraintHistory[:, jdx] + counts
+            minvals[rows] = np.maximum(minvals[rows], lower)
+            maxvals[rows] = np.maximum(maxvals[rows], upper)
+            satisfied[rows[holds], jdx] = upper[holds]
+            # The box is out of range whatever the rest of the constraints are
+            maxvals[rows[rejected]] = np.inf
+            active[rows[rejected]] = False
+        return minvals, maxvals, satisfied
+
+    def __getConstraintFuncs(self):
+        # The constraints of a subclass and whether they are vectorized, None if there are none
+        if 'getBatchConstraints' in dir(self):
+            return list(self.getBatchConstraints()), True
+        if 'getConstraints' in dir(self):
+            return list(self.getConstraints()), False
+        return None
+
+    def __getConstraintOrder(self, nFuncs):
+        # The constraints are sorted by the part of the boxes they discard per second of evaluation
+        if self.__constraintHistory is None or self.__constraintHistory.shape[1] != nFuncs:
+            self.__constraintHistory = np.zeros((4, nFuncs))
+        nEval, nRej, nSat, tEval = self.__constraintHistory
+        rates = (nRej + 1.0)/(nEval + 2.0)
+        costs = tEval/np.maximum(nEval, 1)
+        known = nEval > 0
+        costs[np.logical_not(known)] = np.mean(costs[known]) if known.any() else 1.0
+        return np.argsort(-rates/np.maximum(costs, np.finfo(float).tiny), kind='mergesort')
+
+    def __analyseBoxes(self, minvals, maxvals):
+        #The whole rectangle is a part of the solution -> mark it as in range
+        inrange = maxvals < -self.__eps
+        #There is no solution for the rectangle -> get rid of it
+        outrange = np.logical_and(np.logical_not(inrange), minvals > self.__eps)
+        #The rest of the rectangles should be processed further
+        cont = np.logical_not(np.logical_or(inrange, outrange))
+        return cont, inrange
+
+    def __placeBoxes(self, diams, cont, inrange):
+        #The diameter of the rectangle is less than or equal to the predefined delta value,
+        #it is too small but we have to analyze it before quit
+        small = diams <= self.__delta
+        inQE = np.logical_and(small, cont)
+        inQI = np.copy(inrange)
+        return inQE, inQI, small
+
+    def __getBudgetExceeded(self, nIter, nBoxes, tPerBox):
+        # Would the next level take the run over its budget
+        deadline, maxTime, maxBoxes = self.__budget
+        if maxBoxes is not None and nIter + nBoxes > maxBoxes:
+            return 'boxes'
+        if deadline is not None and time.time() + nBoxes*tPerBox > deadline:
+            return 'time'
+        return None
+
+    def __stopLevel(self, corners, sides, parents, level, diams, tLevel, sStop):
+        nBoxes = corners.shape[0]
+        if not self.__bQuiet:
+            print 'The budget ({}) is exceeded, {} boxes are left in the boundary'.format(sStop, nBoxes)
+        self.__sStop = sStop
+        self.__tEval = 0.0
+        self.__nEvaluated = 0
+        # The boxes have not been decided, so they are in inQE
+        self.__addToTree(corners, sides, parents, level, np.zeros(nBoxes, dtype=bool), np.zeros(nBoxes, dtype=bool), \
+                         np.ones(nBoxes, dtype=bool), np.zeros(nBoxes, dtype=bool), np.ones(nBoxes, dtype=bool), \
+                         np.full(nBoxes, np.nan), np.full(nBoxes, np.nan))
+        self.__addStatistics(level, diams, np.zeros(nBoxes, dtype=bool), np.zeros(nBoxes, dtype=bool), \
+                             np.ones(nBoxes, dtype=bool), np.zeros(nBoxes, dtype=bool), np.ones(nBoxes, dtype=bool), \
+                             time.time() - tLevel, 0.0)
+
+    def __addStatistics(self, level, diams, split, inrange, cont, inQI, inQE, tLevel, tDraw):
+        stats = {'level': int(level), 'diam': float(np.max(diams)), 'boxes': int(diams.shape[0]),
+                 'evaluated': int(self.__nEvaluated), 'inQI': int(np.sum(inQI)), 'inQE': int(np.sum(inQE)),
+                 'discarded': int(np.sum(np.logical_not(np.logical_or(cont, inrange)))),
+                 'split': int(np.sum(split)),
+                 'undecided': int(np.sum(cont & np.logical_not(split) & np.logical_not(inQE))),
+                 'evalTime': self.__tEval, 'drawTime': tDraw, 'engineTime': tLevel - self.__tEval - tDraw,
+                 'time': tLevel, 'memory': getMemoryUsage()}
+        self.__stats.append(stats)
+        for callback in self.__callbacks:
+            callback(stats)
+
+    def __addToTree(self, corners, sides, parents, level, split, inrange, cont, inQI, inQE, \
+                    minvals, maxvals):
+        # Append a processed level to the covering and return the indices of its boxes
+        self.__nodes = None
+        self.__sTree = None
+        nFirst = sum(lvl['level'].shape[0] for lvl in self.__levels)
+        self.__levels.append({'corner': corners, 'sides': sides, 'parent': parents,
+                              'level': np.full(corners.shape[0], level, dtype=np.int32),
+                              'split': split, 'inrange': inrange, 'cont': cont,
+                              'inQI': inQI, 'inQE': inQE,
+                              'minval': minvals, 'maxval': maxvals})
+        return np.arange(nFirst, nFirst + corners.shape[0])
 
     def __initTree(self, Xspace):
-        self.__sTree = Tree('0;')
+        self.__levels = []
+        self.__nodes = None
+        self.__sTree = None
+        corners = np.array([Xspace.getCorner()], dtype=float)
+        sides = np.array([Xspace.getSides()], dtype=float)
+        # The root has no parent and no constraints proved to hold
+        parents = np.array([-1])
+        return corners, sides, parents, None
+
+    def __saveArrays(self, fName, frontier=None, nextLevel=None, nIter=None):
+        # Every array is saved as a .npy file, the rest goes to covering.json.
+        # The files are written to a temporary directory first, so a failure
+        # during the saving does not spoil the previous checkpoint
+        tmpName = fName + '.tmp'
+        shutil.rmtree(tmpName, ignore_errors=True)
+        os.makedirs(tmpName)
+        nodes = self.getNodes()
+        for key in nodes:
+            np.save(os.path.join(tmpName, 'nodes_{}.npy'.format(key)), nodes[key])
+        if frontier is not None:
+            for key, arr in zip(('corner', 'sides', 'parent', 'satisfied'), frontier):
+                if arr is not None:
+                    np.save(os.path.join(tmpName, 'frontier_{}.npy'.format(key)), arr)
+        header = {'iBox': {'corner': self.__Xspace.getCorner().tolist(),
+                           'sides': self.__Xspace.getSides().tolist()},
+                  'iDelta': float(self.__delta), 'iEps': float(self.__eps), 'bShow': bool(self.__bShow),
+                  'nLevelsProcessed': None if self.__nLevelsProcessed is None else int(self.__nLevelsProcessed),
+                  'nIterations': None if self.__nIterations is None else int(self.__nIterations),
+                  'nextLevel': nextLevel, 'nIter': None if nIter is None else int(nIter)}
+        with open(os.path.join(tmpName, 'covering.json'), 'w') as f:
+            json.dump(header, f)
+        # Replace the previous version
+        oldName = fName + '.old'
+        if os.path.isdir(fName):
+            shutil.rmtree(oldName, ignore_errors=True)
+            os.rename(fName, oldName)
+        os.rename(tmpName, fName)
+        shutil.rmtree(oldName, ignore_errors=True)
+
+    def __loadArrays(self, fName, bMmap):
+        nodes, header = loadNodes(fName, bMmap)
+        self.__Xspace = Box(header['iBox']['corner'], header['iBox']['sides'])
+        self.__delta = header['iDelta']
+        self.__eps = header['iEps']
+        self.__bShow = header['bShow']
+        self.__nLevelsProcessed = header['nLevelsProcessed']
+        self.__nIterations = header['nIterations']
+        self.__nodes = nodes
+        self.__levels = [self.__nodes]
+        self.__sTree = None
+        # The run has been finished
+        if header['nextLevel'] is None:
+            return None, None, None
+        return header['frontier'], header['nextLevel'], header['nIter']
+
+    @staticmethod
+    def __buildTree(nodes):
+        from ete3 import Tree
+        sTree = Tree('0;')
         # name here is the level of the tree
-        motherNode = self.__sTree.search_nodes(name='0')[0]
-        motherNode.add_feature('Box', Xspace)
+        eteNodes = [None]*nodes['parent'].shape[0]
+        eteNodes[0] = sTree.search_nodes(name='0')[0]
+        # Add the children in the reversed order to keep the layout of the former trees
+        order = np.lexsort((-np.arange(nodes['parent'].shape[0]), nodes['parent']))
+        for idx in order[1:]:
+            oNode = eteNodes[nodes['parent'][idx]].add_child(name='{}'.format(nodes['level'][idx]))
+            eteNodes[idx] = oNode
+        for idx, oNode in enumerate(eteNodes):
+            #add features
+            oNode.add_feature('Box', Box(nodes['corner'][idx], nodes['sides'][idx]))
+            if not nodes['split'][idx]:
+                #save results to the analyzed node
+                oNode.add_feature('Inrange', nodes['inrange'][idx])
+                oNode.add_feature('inQI', nodes['inQI'][idx])
+                oNode.add_feature('inQE', nodes['inQE'][idx])
+        return sTree
+
+    @staticmethod
+    def __getNodesFromTree(sTree):
+        # The level order keeps the children of a box next to each other
+        eteNodes = list(sTree.traverse('levelorder'))
+        ids = dict((id(oNode), idx) for idx, oNode in enumerate(eteNodes))
+        split = np.array([not oNode.is_leaf() for oNode in eteNodes])
+        # Only the leaves have been classified
+        inrange = np.array([bool(getattr(oNode, 'Inrange', False)) for oNode in eteNodes])
+        inQI = np.array([bool(getattr(oNode, 'inQI', False)) for oNode in eteNodes])
+        inQE = np.array([bool(getattr(oNode, 'inQE', False)) for oNode in eteNodes])
+        return {'corner': np.array([oNode.Box.getCorner() for oNode in eteNodes], dtype=float),
+                'sides': np.array([oNode.Box.getSides() for oNode in eteNodes], dtype=float),
+                'parent': np.array([ids[id(oNode.up)] if oNode.up is not None else -1 \
+                                    for oNode in eteNodes]),
+                'level': np.array([int(oNode.name) for oNode in eteNodes], dtype=np.int32),
+                # The boxes that have not been decided are in the boundary
+                'split': split, 'inrange': inrange, 'cont': np.logical_or(split, inQE),
+                'inQI': inQI, 'inQE': inQE,
+                # The enclosures have not been saved with the tree
+                'minval': np.full(len(eteNodes), np.nan), 'maxval': np.full(len(eteNodes), np.nan)}
 
     def __setTree(self, T):
         # Initialize initial Space where the workspace lie
@@ -250,5 +1167,6 @@ class CoveringTree(object):
         self.__bShow = T['bShow']
         # The Tree sturcture
         self.__sTree = T['Tree']
-
-
+        # The arrays are obtained from the tree on demand
+        self.__levels = []
+        self.__nodes = None
@@ -5,19 +5,24 @@ from math import pi
 import numpy as np
 # Date and Time
 import datetime
-# Plotting 2D boxes
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-# Plotting 3D boxes
-from mpl_toolkits.mplot3d import Axes3D
-# Tree Structure
-from ete3 import Tree
+# Choosing the backend
+import os
+import sys
 from interval import interval
 # Saving as a json file
 from Utils_jsonSaving import saveDataToFile
 
-# Refinement
-from scipy import optimize
+# matplotlib is imported when something is drawn for the first time,
+# so the covering could be obtained without it and without a display
+def getPyplot():
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        # There is no display, the figures could be saved to the files only
+        if sys.platform.startswith('linux') and not os.environ.get('MPLBACKEND') and \
+           not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+            matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 class PlottingTree(object):
 ############################################################################################
@@ -37,6 +42,7 @@ class PlottingTree(object):
 
     def InitPlottingFacilities(self, iBox, Prj2D=True, idxs=[2,], vals=[(10.0/180.0)*pi,]):
         #Initialize plotting facilities
+        plt = getPyplot()
         self.__fig = plt.figure()
         if iBox.getSides().shape[0] == 2 or Prj2D:
             self.__ax = self.__fig.add_subplot(111)
@@ -46,6 +52,8 @@ class PlottingTree(object):
             self.indxs = idxs
             self.vals = vals
         else:
+            # Plotting 3D boxes
+            from mpl_toolkits.mplot3d import Axes3D
             self.__ax = self.__fig.add_subplot(111, projection='3d')
             self.__ax.axis('scaled')
             bnds = iBox.getBounds()
@@ -55,9 +63,11 @@ class PlottingTree(object):
             self.__ax._axis3don = False
 
     def drawCircle(self, center, radius):
+        import matplotlib.patches as patches
         self.__ax.add_patch(patches.Circle(center, radius, fill=False, lw=1, ls='dashed', color='black'))
 
     def drawArc(self, center, radius, psi):
+        import matplotlib.patches as patches
         self.__ax.add_patch(patches.Arc(center, 2*radius, 2*radius, 0.0, psi[0]*180.0/np.pi, psi[1]*180.0/np.pi, color='orange'))
 
     def drawLine(self, center, radius, psi):
@@ -92,6 +102,7 @@ class PlottingTree(object):
         return edgeColor, LineStyle, LineWidth, Alpha, inQI
 
     def __drawBox(self, iBox, edgeColor, lineStyle, lineWidth, Alpha, Fill):
+        import matplotlib.patches as patches
         sides = iBox.getSides()[:2]
         self.__ax.add_patch(patches.Rectangle(iBox.getCorner()[:2],       # (x,y)
                                               sides[0],                   # width
@@ -131,32 +142,143 @@ class PlottingTree(object):
         if iBox.getDim() > 3:
             print 'TODO: Project it onto a three-dimensional hyperplane'
 
+    def drawLeaves(self, leaves):
+        # Draw a lot of boxes at once: one collection for every class of the boxes.
+        # leaves is a dict of arrays like CoveringTree.getLeaves() gives
+        from matplotlib.collections import PolyCollection
+        plt = getPyplot()
+        corners, sides, inQI, inQE = self.__getLeaves2D(leaves)
+        for bInQI, bInQE in ((False, False), (True, False), (False, True)):
+            mask = np.logical_and(inQI == bInQI, inQE == bInQE)
+            if not mask.any():
+                continue
+            edgeColor, lineStyle, lineWidth, Alpha, Fill = self.__getBoxFeatures(bInQI, bInQE)
+            lower = corners[mask]
+            upper = lower + sides[mask]
+            verts = np.stack((lower, np.stack((upper[:, 0], lower[:, 1]), axis=1),
+                              upper, np.stack((lower[:, 0], upper[:, 1]), axis=1)), axis=1)
+            self.__ax.add_collection(PolyCollection(verts,
+                                                    facecolors=plt.rcParams['patch.facecolor'] if Fill else 'none',
+                                                    edgecolors=edgeColor,
+                                                    linestyles=lineStyle,
+                                                    linewidths=lineWidth,
+                                                    alpha=Alpha))
+
+    def rasterizeLeaves(self, leaves, bounds, resolution=2000):
+        # Paint the boxes straight into an RGB pixel buffer (the first row is the bottom of bounds).
+        # The boxes smaller than a pixel are merged into the pixel, the boundary boxes are on the top
+        from matplotlib.colors import to_rgba
+        plt = getPyplot()
+        corners, sides, inQI, inQE = self.__getLeaves2D(leaves)
+        (xmin, xmax), (ymin, ymax) = bounds[0], bounds[1]
+        width = int(resolution)
+        height = max(1, int(round(resolution*(ymax - ymin)/(xmax - xmin))))
+        cols = np.clip((corners[:, 0] - xmin)/(xmax - xmin)*width, 0, width)
+        colsEnd = np.clip((corners[:, 0] + sides[:, 0] - xmin)/(xmax - xmin)*width, 0, width)
+        rows = np.clip((corners[:, 1] - ymin)/(ymax - ymin)*height, 0, height)
+        rowsEnd = np.clip((corners[:, 1] + sides[:, 1] - ymin)/(ymax - ymin)*height, 0, height)
+        c0 = np.minimum(np.floor(cols).astype(np.int64), width - 1)
+        c1 = np.maximum(np.ceil(colsEnd).astype(np.int64), c0 + 1)
+        r0 = np.minimum(np.floor(rows).astype(np.int64), height - 1)
+        r1 = np.maximum(np.ceil(rowsEnd).astype(np.int64), r0 + 1)
+        image = np.ones((height, width, 3))
+        for bInQI, bInQE in ((False, False), (True, False), (False, True)):
+            mask = np.logical_and(inQI == bInQI, inQE == bInQE)
+            if not mask.any():
+                continue
+            edgeColor, lineStyle, lineWidth, Alpha, Fill = self.__getBoxFeatures(bInQI, bInQE)
+            alpha = 1.0 if Alpha is None else Alpha
+            if Fill:
+                covered = self.__coverPixels(r0[mask], r1[mask], c0[mask], c1[mask], height, width) > 0
+                color = np.array(to_rgba(plt.rcParams['patch.facecolor'])[:3])
+                image[covered] = (1.0 - alpha)*image[covered] + alpha*color
+            # The edges of the boxes bigger than a pixel
+            big = mask & (c1 - c0 > 2) & (r1 - r0 > 2)
+            edges = self.__coverPixels(r0[mask], r1[mask], c0[mask], c1[mask], height, width) \
+                    - self.__coverPixels(r0[big] + 1, r1[big] - 1, c0[big] + 1, c1[big] - 1, height, width) > 0
+            color = np.array(to_rgba(edgeColor)[:3])
+            image[edges] = (1.0 - alpha)*image[edges] + alpha*color
+        return image
+
     def saveResultAsImage(self, iTree, fileName='./Images/{0}__{1:02d}_{2:02d}_{3:02d}_covering.eps'.format(datetime.date.today(), \
                                             datetime.datetime.now().hour,\
                                             datetime.datetime.now().minute,\
                                             datetime.datetime.now().second),\
-                                            AddRings=False):
+                                            AddRings=False, raster=False, resolution=2000):
+        # iTree is an ete3 tree or a dict of the arrays of the leaves (CoveringTree.getLeaves()).
+        # The leaves are drawn as collections, or as a single image if raster is True
         print 'Saving the image...'
+        if isinstance(iTree, dict):
+            leaves = iTree
+            iBox = self.__getInitialBox(leaves)
+        else:
+            leaves = self.__getLeavesFromTree(iTree)
+            iBox = iTree.search_nodes(name='0')[0].Box
         if not hasattr(self, '__fig'):
-            self.InitPlottingFacilities(iTree.search_nodes(name='0')[0].Box)
+            self.InitPlottingFacilities(iBox)
         else:
             #Get information on the initial box
-            bnds = iTree.search_nodes(name='0')[0].Box.getBounds()
+            bnds = iBox.getBounds()
             self.__ax.axis([bnds[0][0], bnds[0][1], bnds[1][0], bnds[1][1]])
 
         print 'Drawing rectangles...'
-        for leaf in iTree.iter_leaves():
-            #Draw the rectangle with edges
-            self.drawBox(leaf.Box, leaf.Inrange, leaf.inQI, leaf.inQE)
+        if raster:
+            bnds = iBox.getBounds()
+            image = self.rasterizeLeaves(leaves, bnds, resolution)
+            self.__ax.imshow(image, origin='lower', interpolation='nearest',
+                             extent=(bnds[0][0], bnds[0][1], bnds[1][0], bnds[1][1]))
+        else:
+            self.drawLeaves(leaves)
 
         if AddRings:
             print 'Additional Plotting...'
             # Call an abstract method
             self.AdditionalPlotting(self.__ax)
         print 'Drawing the Figure...'
+        plt = getPyplot()
         plt.draw()
         plt.pause(1)
         #Save the result
         print 'Saving the image...'
-        self.__fig.savefig(fileName, dpi=1200)
+        dpi = 1200
+        if raster:
+            # There is no need in more pixels than the image has
+            dpi = float(resolution)/(self.__fig.get_figwidth()*self.__ax.get_position().width)
+        self.__fig.savefig(fileName, dpi=dpi)
         print 'The image has been saved correctly'
+
+    def __getLeaves2D(self, leaves):
+        corners = np.asarray(leaves['corner'])
+        sides = np.asarray(leaves['sides'])
+        inQI = np.asarray(leaves['inQI'], dtype=bool)
+        inQE = np.asarray(leaves['inQE'], dtype=bool)
+        # Take the boxes that cross the plane of the projection
+        if corners.shape[1] == 3:
+            idx = self.indxs[0]
+            mask = np.logical_and(corners[:, idx] <= self.vals[0], corners[:, idx] + sides[:, idx] >= self.vals[0])
+            corners, sides, inQI, inQE = corners[mask], sides[mask], inQI[mask], inQE[mask]
+        return corners[:, :2], sides[:, :2], inQI, inQE
+
+    @staticmethod
+    def __coverPixels(r0, r1, c0, c1, height, width):
+        # The number of the boxes covering every pixel, the boxes are the
+        # half-open ranges of the pixels [r0, r1) x [c0, c1)
+        idxs = np.concatenate((r0*(width + 1) + c0, r0*(width + 1) + c1, r1*(width + 1) + c0, r1*(width + 1) + c1))
+        weights = np.repeat([1, -1, -1, 1], r0.shape[0])
+        diff = np.bincount(idxs, weights, minlength=(height + 1)*(width + 1)).reshape(height + 1, width + 1)
+        return np.cumsum(np.cumsum(diff, axis=0), axis=1)[:height, :width]
+
+    @staticmethod
+    def __getLeavesFromTree(iTree):
+        leaves = list(iTree.iter_leaves())
+        return {'corner': np.array([leaf.Box.getCorner() for leaf in leaves], dtype=float),
+                'sides': np.array([leaf.Box.getSides() for leaf in leaves], dtype=float),
+                'inQI': np.array([bool(leaf.inQI) for leaf in leaves]),
+                'inQE': np.array([bool(leaf.inQE) for leaf in leaves])}
+
+    @staticmethod
+    def __getInitialBox(leaves):
+        from Utils_NUC import Box
+        lower = np.min(leaves['corner'], axis=0)
+        upper = np.max(np.asarray(leaves['corner']) + np.asarray(leaves['sides']), axis=0)
+        return Box(lower, upper - lower)
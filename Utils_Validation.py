@@ -0,0 +1,107 @@
+############################################################################################
+#              Validation of the interval enclosures by global optimization
+############################################################################################
+# numpy
+import numpy as np
+# Parallel processing
+import multiprocessing
+# Boxes and intervals
+from interval import interval
+from Utils_NUC import Box
+# Saving as a json lines file
+from Utils_jsonSaving import JsonLinesWriter, getRecord
+# Refinement
+from scipy import optimize
+
+# The functions a worker process validates the boxes with
+_pointFuncs = None
+_intervalFuncs = None
+_nStarts = None
+
+def _initWorker(pointFuncs, intervalFuncs, nStarts):
+    global _pointFuncs, _intervalFuncs, _nStarts
+    _pointFuncs = pointFuncs
+    _intervalFuncs = intervalFuncs
+    _nStarts = nStarts
+
+def getGlobalMinMax(func, bounds, nStarts=5, seed=0):
+    # Estimate the range of func over the box by the local optimization
+    # from the center of the box and nStarts-1 random points
+    rng = np.random.RandomState(seed)
+    starts = [np.mean(bounds, axis=1)] + [rng.uniform(bounds[:, 0], bounds[:, 1]) for idx in range(nStarts - 1)]
+    minval = np.inf
+    maxval = -np.inf
+    for start in starts:
+        res = optimize.minimize(lambda x: func(x), start, method='L-BFGS-B', bounds=bounds)
+        minval = min(minval, float(res.fun))
+        res = optimize.minimize(lambda x: -func(x), start, method='L-BFGS-B', bounds=bounds)
+        maxval = max(maxval, -float(res.fun))
+    return minval, maxval
+
+def _validateBox(task):
+    # Only the bounds of a box come in and the numbers go out
+    idx, bounds = task
+    intervals = _intervalFuncs(Box(bounds[:, 0], bounds[:, 1] - bounds[:, 0]))
+    ranges = [getGlobalMinMax(func, bounds, _nStarts, idx) for func in _pointFuncs]
+    intervals = [[(comp[0], comp[1]) for comp in interval(intl)] for intl in intervals]
+    return idx, intervals, [minval for minval, maxval in ranges], [maxval for minval, maxval in ranges]
+
+def validateCovering(leaves, pointFuncs, intervalFuncs, fName, nSamples=1000, workers=None, nStarts=5, seed=0, \
+                     quiet=False):
+    # Compare the interval enclosures of the gFuncs with their ranges obtained by scipy
+    # over a sample of the leaves of a covering (CoveringTree.getLeaves()):
+    # - pointFuncs are the gFuncs of a point, f(x) -> float;
+    # - intervalFuncs(iBox) gives the list of the interval enclosures of the same gFuncs.
+    # The pairs are streamed to the fName .jsonl file and the overestimation is summarized per level,
+    # the summary is not printed if quiet
+    rng = np.random.RandomState(seed)
+    nLeaves = leaves['corner'].shape[0]
+    # There is nothing to sample from a covering without leaves
+    sample = np.sort(rng.choice(nLeaves, min(nSamples, nLeaves), replace=False)) if nLeaves else \
+             np.zeros(0, dtype=np.int64)
+    corners = np.asarray(leaves['corner'])[sample]
+    bounds = np.stack((corners, corners + np.asarray(leaves['sides'])[sample]), axis=2)
+    levels = np.asarray(leaves['level'])[sample]
+    tasks = [(idx, bounds[idx]) for idx in range(sample.shape[0])]
+    # The same functions are used by the main process if there are no workers
+    _initWorker(pointFuncs, intervalFuncs, nStarts)
+    oPool = None
+    if workers is not None and workers > 1:
+        oPool = multiprocessing.Pool(workers, initializer=_initWorker, initargs=(pointFuncs, intervalFuncs, nStarts))
+    # The widths of the enclosures of the gFuncs and of their ranges
+    intervalWidths = np.full((sample.shape[0], len(pointFuncs)), np.nan)
+    globalWidths = np.full((sample.shape[0], len(pointFuncs)), np.nan)
+    try:
+        results = oPool.imap_unordered(_validateBox, tasks) if oPool is not None else (_validateBox(task) for task in tasks)
+        with JsonLinesWriter(fName) as writer:
+            for idx, intervals, minvals, maxvals in results:
+                intervals = [interval(*comps) for comps in intervals]
+                inx = [interval[lo, hi] for lo, hi in bounds[idx]]
+                record = getRecord(inx, intervals, minvals, maxvals)
+                record['level'] = int(levels[idx])
+                writer.writeRecord(record)
+                intervalWidths[idx] = [intl[-1][1] - intl[0][0] for intl in intervals]
+                globalWidths[idx] = np.asarray(maxvals) - np.asarray(minvals)
+    finally:
+        if oPool is not None:
+            oPool.close()
+            oPool.join()
+    return summarizeOverestimation(levels, intervalWidths, globalWidths, quiet)
+
+def summarizeOverestimation(levels, intervalWidths, globalWidths, quiet=False):
+    # The overestimation is the part of the width of an enclosure that is not reached by the function,
+    # the widths are of the shape (boxes, gFuncs)
+    excess = (intervalWidths - globalWidths)/np.maximum(intervalWidths, np.finfo(float).tiny)
+    summary = {}
+    for level in np.unique(levels):
+        mask = levels == level
+        summary[int(level)] = {'boxes': int(np.sum(mask)),
+                               'meanOverestimation': float(np.mean(excess[mask])),
+                               'maxOverestimation': float(np.max(excess[mask])),
+                               'meanWidthRatio': float(np.mean(intervalWidths[mask]/ \
+                                                       np.maximum(globalWidths[mask], np.finfo(float).tiny))),
+                               'meanOverestimationPerFunc': np.mean(excess[mask], axis=0).tolist()}
+        if not quiet:
+            print 'Level {}: {} boxes, the mean overestimation is {:.1%}'.format(int(level), summary[int(level)]['boxes'], \
+                    summary[int(level)]['meanOverestimation'])
+    return summary
@@ -1,7 +1,11 @@
 import os
 import json
+import numpy as np
 from interval import interval
 
+# The indices of gFunc00, gFunc01, ... in the results of the interval and global optimization
+GFUNC_ORDER = [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 14, 15, 8, 9, 12, 13, 16, 17]
+
 def __writeFile(append, fName, inx, IntervalRes, GlobalOptResMin, GlobalOptResMax):
     if append:
         with open(fName) as f:
@@ -72,8 +76,99 @@ def __writeFile(append, fName, inx, IntervalRes, GlobalOptResMin, GlobalOptResMa
 
 def saveDataToFile(fName, inx, intlres, goptresmin, goptresmax):
     print '...Saving data to {} for the following box:\n x={},\n y={},\n z={}'.format(fName, inx[0], inx[1], inx[2])
+    # A .jsonl file gets one more line, use JsonLinesWriter to save a lot of boxes
+    if fName.endswith('.jsonl'):
+        with JsonLinesWriter(fName, 1) as writer:
+            writer.write(inx, intlres, goptresmin, goptresmax)
+        return
     if os.path.isfile(fName):
         __writeFile(True, fName, inx, intlres, goptresmin, goptresmax)
     else:
         __writeFile(False, fName, inx, intlres, goptresmin, goptresmax)
 
+
+############################################################################################
+# JSON Lines: one record per line, the records are only appended to the file
+############################################################################################
+def _toNumeric(value):
+    # An interval becomes the list of its components [[lo, hi], ...]
+    if isinstance(value, interval):
+        return [[float(comp[0]), float(comp[1])] for comp in value]
+    if np.ndim(value) == 0:
+        return float(value)
+    return [_toNumeric(item) for item in value]
+
+def getRecord(inx, IntervalRes, GlobalOptResMin, GlobalOptResMax):
+    # The gFuncs are renumbered as in the former format for the 18 gFuncs of the model
+    order = GFUNC_ORDER if len(IntervalRes) == len(GFUNC_ORDER) else range(len(IntervalRes))
+    return {
+        'inputs': dict((name, _toNumeric(value)) for name, value in zip(('x', 'y', 'angle'), inx)),
+        'IntervalgFuncs': dict(('gFunc{:02d}'.format(idx), _toNumeric(interval(IntervalRes[jdx]))) \
+                               for idx, jdx in enumerate(order)),
+        'IntervalRes': {'min': max(interval(intl)[0][0] for x in IntervalRes for intl in x),
+                        'max': max(interval(intl)[0][1] for x in IntervalRes for intl in x)},
+        'GlobalOptgFuncs': dict(('gFunc{:02d}'.format(idx), [float(GlobalOptResMin[jdx]), float(GlobalOptResMax[jdx])]) \
+                                for idx, jdx in enumerate(order)),
+        'GlobalOptRes': {'min': float(max(GlobalOptResMin)), 'max': float(max(GlobalOptResMax))}
+    }
+
+class JsonLinesWriter(object):
+    def __init__(self, fName, bufferSize=1000):
+        # The records are kept in memory and written to the file in bulk
+        self.__fName = fName
+        self.__bufferSize = bufferSize
+        self.__lines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def write(self, inx, intlres, goptresmin, goptresmax):
+        self.writeRecord(getRecord(inx, intlres, goptresmin, goptresmax))
+
+    def writeRecord(self, record):
+        self.__lines.append(json.dumps(record))
+        if len(self.__lines) >= self.__bufferSize:
+            self.flush()
+
+    def flush(self):
+        if not self.__lines:
+            return
+        # The last line could be cut by a crash, the new records start on a line of their own
+        bNewLine = False
+        if os.path.isfile(self.__fName) and os.path.getsize(self.__fName) > 0:
+            with open(self.__fName, 'rb') as infile:
+                infile.seek(-1, os.SEEK_END)
+                bNewLine = infile.read(1) != '\n'
+        with open(self.__fName, 'a') as outfile:
+            outfile.write(('\n' if bNewLine else '') + '\n'.join(self.__lines) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        self.__lines = []
+
+    def close(self):
+        self.flush()
+
+def readDataFromFile(fName):
+    # Stream the records back as dicts with the keys 'inputs', 'IntervalgFuncs', 'IntervalRes',
+    # 'GlobalOptgFuncs' and 'GlobalOptRes'; the gFunc values of a .jsonl file are numpy arrays
+    if not fName.endswith('.jsonl'):
+        # The former format keeps the records in lists of strings
+        with open(fName) as f:
+            data = json.load(f)
+        keys = ('inputs', 'IntervalgFuncs', 'IntervalRes', 'GlobalOptgFuncs', 'GlobalOptRes')
+        for values in zip(*[data[key] for key in keys]):
+            yield dict(zip(keys, values))
+        return
+    with open(fName) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line could be cut by a crash
+                continue
+            for key in ('IntervalgFuncs', 'GlobalOptgFuncs'):
+                record[key] = dict((name, np.array(value)) for name, value in record[key].items())
+            yield record